@@ -0,0 +1,92 @@
+import itertools
+import time
+
+# (JPEG quality, downscale factor, max fps), best first. The two ends of the
+# ladder are the bounds the controller moves within.
+LADDER = [
+    (70, 1.0, 10),
+    (50, 1.0, 10),
+    (30, 1.0, 10),
+    (30, 0.75, 8),
+    (25, 0.5, 6),
+    (20, 0.5, 3),
+]
+# Level new clients start at: quality 30, full size, 10 fps (the old fixed setting)
+START_LEVEL = 2
+
+# A send that takes more than this share of the frame interval means the
+# client's socket buffer is full and frames are queueing up
+CONGESTED_SHARE = 0.5
+STEP_DOWN_AFTER = 2
+# Sends under this share of the interval, this many in a row, earn a step up
+CLEAR_SHARE = 0.1
+STEP_UP_AFTER = 20
+
+_client_ids = itertools.count(1)
+
+
+class AdaptiveBitrate:
+    """Picks JPEG quality, downscale factor and frame rate for one stream client.
+
+    Writing a frame blocks once the client's socket buffer is full, so the
+    time a send takes is the backpressure signal: slow sends step down the
+    ladder, a sustained run of fast sends steps back up. Every change is logged.
+    """
+
+    def __init__(self, ladder=LADDER, start=START_LEVEL, log=print):
+        self.client_id = next(_client_ids)
+        self.ladder = ladder
+        self.level = min(start, len(ladder) - 1)
+        self._log = log
+        self._slow = 0
+        self._fast = 0
+        self._next_send = 0.0
+
+    @property
+    def quality(self):
+        return self.ladder[self.level][0]
+
+    @property
+    def scale(self):
+        return self.ladder[self.level][1]
+
+    @property
+    def fps(self):
+        return self.ladder[self.level][2]
+
+    def delay(self):
+        """Seconds until this client's frame rate allows another frame."""
+        return max(0.0, self._next_send - time.monotonic())
+
+    def pace(self):
+        """Sleeps until this client's frame rate allows another frame."""
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+
+    def sent(self, nbytes, seconds):
+        """Records that a frame of nbytes took seconds to write, and adapts."""
+        interval = 1.0 / self.fps
+        self._next_send = time.monotonic() - seconds + interval
+
+        if seconds > interval * CONGESTED_SHARE:
+            self._slow += 1
+            self._fast = 0
+        elif seconds < interval * CLEAR_SHARE:
+            self._fast += 1
+            self._slow = 0
+        else:
+            self._slow = self._fast = 0
+
+        if self._slow >= STEP_DOWN_AFTER and self.level < len(self.ladder) - 1:
+            self._step(1, nbytes, seconds)
+        elif self._fast >= STEP_UP_AFTER and self.level > 0:
+            self._step(-1, nbytes, seconds)
+
+    def _step(self, delta, nbytes, seconds):
+        old = self.level
+        self.level += delta
+        self._slow = self._fast = 0
+        self._log(f"[abr] client {self.client_id}: level {old} -> {self.level} "
+                  f"(quality={self.quality}, scale={self.scale}, fps={self.fps}); "
+                  f"last frame {nbytes} B sent in {seconds * 1000:.1f} ms")
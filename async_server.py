@@ -0,0 +1,381 @@
+import asyncio
+import os
+import secrets
+import time
+import weakref
+
+import jinja2
+from aiohttp import web, WSMsgType
+
+import metrics
+from abr import AdaptiveBitrate
+from frame_codecs import CODECS, TILE_CODEC
+from governor import process_rss_mb
+from recorder import open_recording, replay
+from streaming import (ADAPTIVE_BITRATE, STREAM_KEEPALIVE_SECONDS, WS_TILES,
+                       WS_CODEC, client_variant, requested_size, requested_codec, to_view, parse_input_event, decode_input,
+                       mjpeg_part)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+class AsyncBridge:
+    """Wakes coroutines on the server's event loop when the Qt side publishes.
+
+    notify() is safe to call from any thread. Waiters take the current event
+    before checking for new data, so a publish landing between the check and
+    the wait is never missed.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    async def _wait(self, event, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def wait_for_frame(self, frames, last_seq, timeout):
+        """Async FrameBroadcaster.wait_for_frame."""
+        event = self._event
+        seq, frame = frames.wait_for_frame(last_seq, timeout=0)
+        if seq > last_seq:
+            return seq, frame
+        await self._wait(event, timeout)
+        return frames.wait_for_frame(last_seq, timeout=0)
+
+    async def wait_for_delta(self, tiles, last_seq, timeout):
+        """Async TileEncoder.wait_for_delta."""
+        event = self._event
+        if tiles.seq <= last_seq:
+            await self._wait(event, timeout)
+        return tiles.wait_for_delta(last_seq, timeout=0)
+
+
+async def framed(getter, frame, abr, requested, codec):
+    """Gets a frame variant, encoding it on a worker thread if it isn't cached yet."""
+    quality, width = client_variant(frame, abr, requested)
+    data = getter(quality, width, encode=False, codec=codec)
+    if data is None:
+        data = await asyncio.to_thread(getter, quality, width, codec=codec)
+    return data
+
+
+class AsyncFrontend:
+    """The browser's routes served from one asyncio loop.
+
+    Stream viewers are coroutines instead of pinned threads, and input
+    requests never wait for a free worker behind them. Frames reach the loop
+    through an AsyncBridge registered on each session's broadcaster.
+    """
+
+    def __init__(self, sessions, stream_mode, limit_error, default_session='default'):
+        self.sessions = sessions
+        self.stream_mode = stream_mode
+        # What sessions.get() raises when every live view has clients
+        self.limit_error = limit_error
+        self.default_session = default_session
+        self.loop = None
+        self._bridges = weakref.WeakKeyDictionary()
+
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+        self._index = env.get_template('index.html')
+
+    def routes(self):
+        routes = [web.get('/new', self.new_session), web.get('/sessions', self.list_sessions),
+                  web.get('/healthz', self.healthz), web.get('/metrics', self.metrics_endpoint),
+                  web.get('/recordings/{sid}', self.recording_summary),
+                  web.get('/recordings/{sid}/frame', self.recording_frame),
+                  web.get('/recordings/{sid}/inputs', self.recording_inputs),
+                  web.get('/recordings/{sid}/replay.mjpeg', self.recording_replay)]
+        # Every route exists for the default session and under /s/{sid} for the others
+        for prefix in ('', '/s/{sid}'):
+            routes += [
+                web.get(prefix + '/', self.index),
+                web.get(prefix + '/stream.mjpeg', self.stream),
+                web.get(prefix + '/stream.tiles', self.stream_tiles),
+                web.get(prefix + '/ws', self.ws_channel),
+                web.post(prefix + '/input', self.input_batch),
+            ]
+            for path, handler in (('/click', self.click), ('/type', self.type_key),
+                                  ('/navigate', self.navigate), ('/viewport', self.viewport)):
+                routes += [web.get(prefix + path, handler, allow_head=False), web.post(prefix + path, handler)]
+        return routes
+
+    async def on_startup(self, app):
+        self.loop = asyncio.get_running_loop()
+
+    def session(self, request):
+        """The request's session; raises an HTTP error if it can't be opened."""
+        try:
+            return self.sessions.get(request.match_info.get('sid', self.default_session))
+        except KeyError:
+            raise web.HTTPNotFound(text="No such session")
+        except self.limit_error as e:
+            raise web.HTTPServiceUnavailable(text=str(e))
+
+    def bridge(self, session):
+        """The session's AsyncBridge, registered on its broadcasters on first use."""
+        bridge = self._bridges.get(session)
+        if bridge is None:
+            bridge = self._bridges[session] = AsyncBridge(self.loop)
+            session.frames.add_listener(bridge.notify)
+            if session.tile_encoder is not None:
+                session.tile_encoder.add_listener(bridge.notify)
+        return bridge
+
+    async def new_session(self, request):
+        """Opens a fresh private session and sends the client to it."""
+        raise web.HTTPFound(f'/s/{secrets.token_urlsafe(8)}/')
+
+    async def list_sessions(self, request):
+        return web.json_response({'sessions': self.sessions.describe(), 'rss_mb': round(process_rss_mb())})
+
+    async def healthz(self, request):
+        health = self.sessions.health()
+        return web.json_response(health, status=200 if health['ok'] else 503)
+
+    async def metrics_endpoint(self, request):
+        return web.Response(body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    async def index(self, request):
+        session = self.session(request)
+        base = '/s/' + session.id if 'sid' in request.match_info else ''
+        return web.Response(text=self._index.render(stream_mode=self.stream_mode, base=base,
+                                                 tile_mime=TILE_CODEC.mime),
+                            content_type='text/html')
+
+    async def stream(self, request):
+        session = self.session(request)
+        bridge = self.bridge(session)
+        requested = requested_size(request.query)
+        codec = requested_codec(request.query)
+        resp = web.StreamResponse()
+        resp.content_type = 'multipart/x-mixed-replace; boundary=frame'
+        await resp.prepare(request)
+
+        abr = AdaptiveBitrate() if ADAPTIVE_BITRATE else None
+        seq = 0
+        with session.attached(), session.frames.viewer():
+            try:
+                while not session.closed:
+                    if abr:
+                        await asyncio.sleep(abr.delay())
+                    seq, frame = await bridge.wait_for_frame(session.frames, seq, STREAM_KEEPALIVE_SECONDS)
+                    if frame is None:
+                        continue
+                    part = await framed(frame.mjpeg_part, frame, abr, requested, codec)
+
+                    # write() waits for the transport to drain, which is our backpressure signal
+                    start = time.monotonic()
+                    await resp.write(part)
+                    elapsed = time.monotonic() - start
+                    metrics.record_send(len(part), elapsed)
+                    if abr:
+                        abr.sent(len(part), elapsed)
+            except ConnectionResetError:
+                pass
+        return resp
+
+    async def stream_tiles(self, request):
+        session = self.session(request)
+        if session.tile_encoder is None:
+            return web.Response(text="Tile streaming is disabled (set STREAM_MODE=tiles)", status=404)
+        bridge = self.bridge(session)
+        resp = web.StreamResponse()
+        resp.content_type = 'application/octet-stream'
+        await resp.prepare(request)
+
+        seq = 0
+        with session.attached():
+            try:
+                while not session.closed:
+                    seq, message = await bridge.wait_for_delta(session.tile_encoder, seq, STREAM_KEEPALIVE_SECONDS)
+                    if message:
+                        start = time.monotonic()
+                        await resp.write(message)
+                        metrics.record_send(len(message), time.monotonic() - start)
+            except ConnectionResetError:
+                pass
+        return resp
+
+    @staticmethod
+    def recording(request):
+        """The request's RecordingReader; raises 404 if there is none."""
+        try:
+            return open_recording(request.match_info['sid'])
+        except FileNotFoundError:
+            raise web.HTTPNotFound(text="No such recording")
+
+    @staticmethod
+    def query_float(request, name, default):
+        try:
+            return float(request.query[name]) if name in request.query else default
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"Invalid {name}")
+
+    async def recording_summary(self, request):
+        with self.recording(request) as reader:
+            return web.json_response(reader.summary())
+
+    async def recording_frame(self, request):
+        t = self.query_float(request, 't', 0.0)
+        with self.recording(request) as reader:
+            found = reader.frame_at(t)
+            if found is None:
+                raise web.HTTPNotFound(text="No frame recorded at or before that time")
+            timestamp, codec_name, data = found
+            return web.Response(body=data, content_type=CODECS[codec_name].mime,
+                                headers={'X-Timestamp': repr(timestamp)})
+
+    async def recording_inputs(self, request):
+        start = self.query_float(request, 'from', 0.0)
+        end = self.query_float(request, 'to', float('inf'))
+        with self.recording(request) as reader:
+            inputs = reader.inputs_between(start, end)
+        return web.json_response({'inputs': [{'t': t, 'commands': commands} for t, commands in inputs]})
+
+    async def recording_replay(self, request):
+        start = self.query_float(request, 't', 0.0)
+        speed = self.query_float(request, 'speed', 1.0)
+        if speed <= 0:
+            raise web.HTTPBadRequest(text="Invalid speed")
+        with self.recording(request) as reader:
+            resp = web.StreamResponse()
+            resp.content_type = 'multipart/x-mixed-replace; boundary=frame'
+            await resp.prepare(request)
+            try:
+                for wait, codec_name, data in replay(reader, start, speed):
+                    await asyncio.sleep(wait)
+                    await resp.write(mjpeg_part(CODECS[codec_name].mime, data))
+            except ConnectionResetError:
+                pass
+        return resp
+
+    async def click(self, request):
+        session = self.session(request)
+        try:
+            x, y = to_view(session.frames.view_size(), request.query.get('x'), request.query.get('y'),
+                           request.query.get('fw'), request.query.get('fh'))
+            session.commands.put(('click', x, y))
+            return web.Response(text="Clicked")
+        except Exception as e:
+            return web.Response(text=str(e), status=400)
+
+    async def type_key(self, request):
+        session = self.session(request)
+        key = request.query.get('key')
+        if key is None:
+            return web.Response(text="Missing key", status=400)
+        session.commands.put(('type', key))
+        return web.Response(text="Typed")
+
+    async def navigate(self, request):
+        session = self.session(request)
+        url = request.query.get('url')
+        if url is None:
+            return web.Response(text="Missing url", status=400)
+        session.commands.put(('navigate', url))
+        return web.Response(text="Navigating")
+
+    async def viewport(self, request):
+        session = self.session(request)
+        try:
+            if request.query.get('w'):
+                session.commands.put(('resize', int(request.query['w']), int(request.query['h'])))
+        except Exception as e:
+            return web.Response(text=str(e), status=400)
+        width, height = session.frames.view_size()
+        return web.json_response({'width': width, 'height': height})
+
+    async def input_batch(self, request):
+        session = self.session(request)
+        try:
+            view_size = session.frames.view_size()
+            commands = [parse_input_event(event, view_size) for event in (await request.json())['events']]
+        except Exception as e:
+            return web.Response(text=str(e), status=400)
+        for command in commands:
+            session.commands.put(command)
+        return web.Response(text="Queued")
+
+    async def ws_channel(self, request):
+        session = self.session(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client = {'size': requested_size(request.query), 'codec': requested_codec(request.query)}
+        pump = asyncio.create_task(self._pump_frames(ws, session, client))
+
+        last_seq = 0
+        try:
+            with session.attached():
+                async for msg in ws:
+                    if msg.type != WSMsgType.BINARY:
+                        continue
+                    try:
+                        seq, command = decode_input(msg.data)
+                    except Exception as e:
+                        print(f"Bad input message: {e}")
+                        continue
+                    # Events are applied strictly in seq order; stale or duplicate ones are dropped
+                    if seq <= last_seq:
+                        continue
+                    last_seq = seq
+                    if command[0] == 'viewport':
+                        client['size'] = command[1:]
+                    else:
+                        session.commands.put(command)
+        finally:
+            pump.cancel()
+        return ws
+
+    async def _pump_frames(self, ws, session, client):
+        seq = 0
+        bridge = self.bridge(session)
+        abr = AdaptiveBitrate() if ADAPTIVE_BITRATE else None
+        try:
+            if session.tile_encoder is None:
+                await ws.send_bytes(bytes([WS_CODEC]) + client['codec'].name.encode())
+            while not ws.closed and not session.closed:
+                if session.tile_encoder is not None:
+                    seq, message = await bridge.wait_for_delta(session.tile_encoder, seq, STREAM_KEEPALIVE_SECONDS)
+                    if message:
+                        start = time.monotonic()
+                        await ws.send_bytes(bytes([WS_TILES]) + message)
+                        metrics.record_send(len(message) + 1, time.monotonic() - start)
+                    continue
+
+                if abr:
+                    await asyncio.sleep(abr.delay())
+                seq, frame = await bridge.wait_for_frame(session.frames, seq, STREAM_KEEPALIVE_SECONDS)
+                if frame is None:
+                    continue
+                message = await framed(frame.ws_message, frame, abr, client['size'], client['codec'])
+                start = time.monotonic()
+                await ws.send_bytes(message)
+                elapsed = time.monotonic() - start
+                metrics.record_send(len(message), elapsed)
+                if abr:
+                    abr.sent(len(message), elapsed)
+        except ConnectionResetError:
+            pass
+
+
+def run_async_server(frontend, host='0.0.0.0', port=5000):
+    """Runs the asyncio front end on its own event loop in the calling thread."""
+    app = web.Application()
+    app.add_routes(frontend.routes())
+    app.on_startup.append(frontend.on_startup)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    web.run_app(app, host=host, port=port, handle_signals=False, print=None, loop=loop)
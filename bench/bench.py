@@ -0,0 +1,382 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+# Offline benchmark: runs browser.py under Qt's offscreen platform on the
+# local fixture pages in bench/pages, drives simulated stream clients and
+# input against the HTTP endpoints, and writes the results as JSON so
+# releases can be compared. Needs no network access.
+#
+#   python bench/bench.py --clients 4 --duration 20 --output results.json
+#   python bench/bench.py --codecs jpeg webp png    # CPU and bandwidth of each frame codec
+#   python bench/bench.py --baseline results.json    # report changes against an earlier run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES_DIR = os.path.join(ROOT, 'bench', 'pages')
+BROWSER_SCRIPT = os.path.join(ROOT, 'browser.py')
+
+BENCH_PORT = 5300
+BENCH_DEVTOOLS_PORT = 9400
+STARTUP_TIMEOUT = 60.0
+# Gap between inputs, so each one's frame can be told apart from the next
+INPUT_INTERVAL = 0.25
+# An input with no visible change within this long counts as missed
+INPUT_TIMEOUT = 2.0
+
+# Input events each scenario sends (None: streaming only)
+SCENARIOS = {
+    'static': None,
+    'animated': None,
+    'scroll': lambda i: {'type': 'wheel', 'x': 400, 'y': 300, 'dx': 0, 'dy': 120},
+    'text': lambda i: {'type': 'key', 'key': 'abcdefghijklmnopqrstuvwxyz'[i % 26]},
+}
+
+# Lower is better for all of these except fps
+COMPARED = ('fps', 'bytes_per_second', 'cpu_ms_per_frame', 'encode_ms_per_frame',
+            'input_latency_p50_ms', 'input_latency_p99_ms', 'rss_peak_mb')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, or None without samples."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        # Fields after the command name, which may itself contain spaces
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def process_memory_mb(pid):
+    """(current RSS, peak RSS) in MB."""
+    values = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(rest.split()[0]) / 1024
+    return values.get('VmRSS', 0.0), values.get('VmHWM', 0.0)
+
+
+def scrape(port):
+    """Unlabelled values from the browser's /metrics."""
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as resp:
+        text = resp.read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+class StreamClient(threading.Thread):
+    """Reads /stream.mjpeg like a viewer and notes when the picture changes."""
+
+    def __init__(self, port, width=0, height=0, codec='jpeg'):
+        super().__init__(daemon=True)
+        self.port = port
+        self.size = (width, height)
+        self.codec = codec
+        self.parts = 0
+        self.changes = 0
+        self.bytes = 0
+        self.error = None
+        self.changed_at = 0.0
+        self._last = None
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def run(self):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            conn.request('GET', f'/stream.mjpeg?w={self.size[0]}&h={self.size[1]}&codec={self.codec}')
+            resp = conn.getresponse()
+            while not self._stopped:
+                data = self._read_part(resp)
+                if data is None:
+                    break
+                self._received(data)
+            conn.close()
+        except Exception as e:
+            if not self._stopped:
+                self.error = str(e)
+
+    def _read_part(self, resp):
+        length = None
+        while True:
+            line = resp.readline()
+            if not line:
+                return None
+            line = line.strip()
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+            elif not line and length is not None:
+                break
+        data = resp.read(length)
+        resp.readline()
+        return data
+
+    def _received(self, data):
+        now = time.monotonic()
+        with self._cond:
+            self.parts += 1
+            self.bytes += len(data)
+            # Keep-alive resends repeat the last frame; only new pictures count
+            if data != self._last:
+                self._last = data
+                self.changes += 1
+                self.changed_at = now
+                self._cond.notify_all()
+
+    def reset(self):
+        with self._cond:
+            self.parts = self.changes = self.bytes = 0
+
+    def wait_for_change(self, after, timeout):
+        """Arrival time of the first new picture after `after`, or None on timeout."""
+        with self._cond:
+            if self._cond.wait_for(lambda: self.changed_at > after, timeout):
+                return self.changed_at
+        return None
+
+    def stop(self):
+        self._stopped = True
+
+
+class InputDriver(threading.Thread):
+    """Sends one input at a time to /input and times it until the probe sees a new picture."""
+
+    def __init__(self, port, make_event, probe):
+        super().__init__(daemon=True)
+        self.port = port
+        self.make_event = make_event
+        self.probe = probe
+        self.latencies = []
+        self.missed = 0
+        self._stopped = False
+
+    def run(self):
+        i = 0
+        while not self._stopped:
+            body = json.dumps({'events': [self.make_event(i)]}).encode()
+            req = urllib.request.Request(f'http://127.0.0.1:{self.port}/input', data=body,
+                                         headers={'Content-Type': 'application/json'})
+            sent = time.monotonic()
+            urllib.request.urlopen(req, timeout=5).close()
+            shown = self.probe.wait_for_change(sent, INPUT_TIMEOUT)
+            if shown is None:
+                self.missed += 1
+            else:
+                self.latencies.append(shown - sent)
+            i += 1
+            time.sleep(INPUT_INTERVAL)
+
+    def stop(self):
+        self._stopped = True
+
+
+class BrowserProcess:
+    """browser.py on the offscreen platform, starting on a fixture page."""
+
+    def __init__(self, page, port=BENCH_PORT, extra_env=None):
+        self.port = port
+        self.env = dict(os.environ, QT_QPA_PLATFORM='offscreen', PORT=str(port),
+                        DEVTOOLS_PORT=str(BENCH_DEVTOOLS_PORT),
+                        START_URL='file://' + os.path.join(PAGES_DIR, page))
+        self.env.update(extra_env or {})
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen([sys.executable, BROWSER_SCRIPT], env=self.env, cwd=ROOT,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"browser.py exited with {self.process.returncode}")
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{self.port}/healthz', timeout=2) as resp:
+                    if resp.status == 200:
+                        return self
+            except OSError:
+                pass
+            time.sleep(0.5)
+        self.__exit__()
+        raise RuntimeError("browser.py did not become healthy")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def run_scenario(name, codec, args):
+    page = f'{name}.html'
+    make_event = SCENARIOS[name]
+    # Offer only this codec, so every captured frame is encoded in it and nothing else
+    env = dict(args.env, STREAM_CODECS=codec)
+    with BrowserProcess(page, extra_env=env) as browser:
+        pid = browser.process.pid
+        clients = [StreamClient(browser.port, args.client_width, args.client_height, codec)
+                   for _ in range(args.clients)]
+        for client in clients:
+            client.start()
+        # First picture, then let the page settle
+        if clients[0].wait_for_change(0.0, STARTUP_TIMEOUT) is None:
+            raise RuntimeError(f"{name}: no frame received")
+        time.sleep(args.warmup)
+
+        for client in clients:
+            client.reset()
+        before = scrape(browser.port)
+        cpu_before = process_cpu_seconds(pid)
+        start = time.monotonic()
+
+        # One input generator per viewer, each timing its inputs on its own stream
+        drivers = []
+        if make_event is not None:
+            drivers = [InputDriver(browser.port, make_event, client) for client in clients]
+        for driver in drivers:
+            driver.start()
+        time.sleep(args.duration)
+        for driver in drivers:
+            driver.stop()
+        for driver in drivers:
+            driver.join(INPUT_TIMEOUT + 5)
+
+        elapsed = time.monotonic() - start
+        cpu = process_cpu_seconds(pid) - cpu_before
+        after = scrape(browser.port)
+        rss, rss_peak = process_memory_mb(pid)
+        for client in clients:
+            client.stop()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    published = delta('browser_frames_published_total')
+    encodes = delta('browser_encode_seconds_count')
+    latencies = [s * 1000 for driver in drivers for s in driver.latencies]
+    missed = sum(driver.missed for driver in drivers)
+    result = {
+        'codec': codec,
+        'duration_seconds': round(elapsed, 2),
+        'clients': args.clients,
+        # Distinct pictures per second as a viewer sees them
+        'fps': round(sum(c.changes for c in clients) / len(clients) / elapsed, 2),
+        'frames_published': int(published),
+        'frames_dropped': int(delta('browser_frames_dropped_total')),
+        'bytes_per_second': round(sum(c.bytes for c in clients) / elapsed),
+        'cpu_percent': round(cpu / elapsed * 100, 1),
+        'cpu_ms_per_frame': round(cpu * 1000 / published, 2) if published else None,
+        'encode_ms_per_frame': (round(delta('browser_encode_seconds_sum') * 1000 / encodes, 2)
+                                if encodes else None),
+        'rss_mb': round(rss, 1),
+        'rss_peak_mb': round(rss_peak, 1),
+        'client_errors': [c.error for c in clients if c.error],
+    }
+    if drivers:
+        result.update({
+            'input_generators': len(drivers),
+            'inputs': len(latencies) + missed,
+            'inputs_missed': missed,
+            'input_latency_p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+            'input_latency_p99_ms': round(percentile(latencies, 99), 1) if latencies else None,
+        })
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline):
+    """Prints each compared metric against the baseline run."""
+    for name, result in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old:
+            continue
+        print(f"{name}:")
+        for key in COMPARED:
+            new_value, old_value = result.get(key), old.get(key)
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = change < 0 if key == 'fps' else change > 0
+            flag = "  <-- regression" if worse and abs(change) >= 10 else ""
+            print(f"  {key:24} {old_value:>12} -> {new_value:<12} ({change:+.1f}%){flag}")
+
+
+def parse_env(value):
+    key, sep, val = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE")
+    return key, val
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline capture, stream and input benchmark")
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--codecs', nargs='+', default=['jpeg'],
+                        help="frame codecs to measure (see frame_codecs.py), one run each")
+    parser.add_argument('--clients', type=int, default=2,
+                        help="simulated stream viewers, each also sending input in input scenarios")
+    parser.add_argument('--client-width', type=int, default=0)
+    parser.add_argument('--client-height', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=15.0, help="measured seconds per scenario")
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--env', type=parse_env, action='append', default=[],
+                        help="KEY=VALUE passed to browser.py, e.g. CAPTURE_MODE=timer")
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--baseline', help="earlier results JSON to compare against")
+    args = parser.parse_args()
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {'clients': args.clients, 'client_size': [args.client_width, args.client_height],
+                   'duration': args.duration, 'env': dict(args.env)},
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        for codec in args.codecs:
+            key = f'{name}/{codec}'
+            print(f"[bench] {key}...")
+            results['scenarios'][key] = run_scenario(name, codec, args)
+            print(f"[bench] {key}: {json.dumps(results['scenarios'][key])}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"[bench] wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+from urllib.parse import urljoin, quote_plus
+
+from bs4 import BeautifulSoup
+
+# Benchmark for legacy_proxy's page rewriter: the streaming tokenizer in
+# legacy_proxy/rewriter.py against the BeautifulSoup pass it replaced
+# (kept below as soup_rewrite). Runs on saved pages:
+#
+#   curl -so /tmp/news.html https://news.ycombinator.com/
+#   python bench/rewrite_bench.py /tmp/news.html bench/pages/*.html
+#
+# With no pages it uses bench/pages and a synthetic large page.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'legacy_proxy'))
+
+from rewriter import rewrite_html_stream  # noqa: E402
+
+PAGES_DIR = os.path.join(ROOT, 'bench', 'pages')
+BASE_URL = 'https://example.com/articles/index.html'
+# Upstream chunk size the proxy streams with
+CHUNK_BYTES = 64 * 1024
+
+SYNTHETIC_BLOCK = b'''<div class="story" style="background:url(/img/bg.png)">
+  <a href="/story?id=1&amp;ref=home">Story title</a>
+  <img src="thumb.jpg" srcset="thumb.jpg 1x, thumb@2x.jpg 2x" alt="">
+  <p>Some text with <b>markup</b> and a <a href="https://other.example/">link</a>.</p>
+  <script>var x = "<a href='not-a-link'>";</script>
+</div>
+'''
+
+
+def soup_rewrite(content, base_url):
+    """legacy_proxy's rewriter before the streaming one (one find_all pass per tag kind)."""
+    soup = BeautifulSoup(content, 'html.parser')
+    tags_attributes = {
+        'a': 'href', 'link': 'href', 'script': 'src', 'img': 'src', 'iframe': 'src',
+        'form': 'action', 'source': 'src', 'video': 'src', 'audio': 'src',
+        'object': 'data', 'embed': 'src',
+    }
+    for tag_name, attr in tags_attributes.items():
+        for tag in soup.find_all(tag_name):
+            if tag.has_attr(attr):
+                original = tag[attr]
+                if not original or original.startswith('data:') or original.startswith('#') or original.startswith('javascript:'):
+                    continue
+                tag[attr] = f"/proxy?url={quote_plus(urljoin(base_url, original))}"
+    for meta in soup.find_all('meta', attrs={'http-equiv': lambda x: x and x.lower() == 'refresh'}):
+        if meta.has_attr('content'):
+            parts = meta['content'].split('url=', 1)
+            if len(parts) > 1:
+                target = urljoin(base_url, parts[1].strip("'\" "))
+                meta['content'] = f"{parts[0]}url=/proxy?url={quote_plus(target)}"
+    return str(soup).encode('utf-8')
+
+
+def stream_rewrite(content, base_url):
+    """The streaming rewriter fed in proxy-sized chunks; returns (page, seconds to first output)."""
+    start = time.perf_counter()
+    first = None
+    out = []
+    chunks = (content[i:i + CHUNK_BYTES] for i in range(0, len(content), CHUNK_BYTES))
+    for piece in rewrite_html_stream(chunks, base_url):
+        if first is None:
+            first = time.perf_counter() - start
+        out.append(piece)
+    return b''.join(out), first or 0.0
+
+
+def timed(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def load_pages(paths, synthetic_kb):
+    pages = []
+    for path in paths or sorted(glob.glob(os.path.join(PAGES_DIR, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read()))
+    if synthetic_kb:
+        body = SYNTHETIC_BLOCK * (synthetic_kb * 1024 // len(SYNTHETIC_BLOCK) + 1)
+        pages.append((f'synthetic-{synthetic_kb}kb', b'<html><body>' + body + b'</body></html>'))
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming rewriter vs BeautifulSoup on saved pages")
+    parser.add_argument('pages', nargs='*', help="saved HTML files (default: bench/pages + a synthetic page)")
+    parser.add_argument('--runs', type=int, default=5, help="timed runs per page (median is reported)")
+    parser.add_argument('--synthetic-kb', type=int, default=None,
+                        help="also rewrite a generated page of this size (default 2048 without pages, else none)")
+    args = parser.parse_args()
+    synthetic_kb = args.synthetic_kb if args.synthetic_kb is not None else (0 if args.pages else 2048)
+
+    print(f"{'page':<24}{'KB':>8}{'soup ms':>10}{'stream ms':>11}{'speedup':>9}{'first byte ms':>15}")
+    for name, content in load_pages(args.pages, synthetic_kb):
+        soup_seconds, _ = timed(lambda: soup_rewrite(content, BASE_URL), args.runs)
+        stream_seconds, (_, first) = timed(lambda: stream_rewrite(content, BASE_URL), args.runs)
+        print(f"{name[:23]:<24}{len(content) / 1024:>8.0f}{soup_seconds * 1000:>10.1f}"
+              f"{stream_seconds * 1000:>11.1f}{soup_seconds / max(stream_seconds, 1e-9):>8.1f}x"
+              f"{first * 1000:>15.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,197 +1,1063 @@
-from flask import Flask, send_file, request, Response, render_template
+from flask import Flask, send_file, request, Response, render_template, redirect
+from flask_sock import Sock, ConnectionClosed
+import os
+import itertools
+import re
+import secrets
 import sys
 import threading
-import queue
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt6.QtCore import QUrl, QTimer, QBuffer, QIODevice, Qt, QPoint, QPointF, QEvent
+from PyQt6.QtCore import (QUrl, QTimer, Qt, QPoint, QPointF, QEvent,
+                          QObject, QElapsedTimer, pyqtSignal)
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QToolBar, QLineEdit, 
                              QPushButton, QVBoxLayout, QWidget)
 from PyQt6.QtWebEngineWidgets import QWebEngineView
-from PyQt6.QtGui import QAction, QIcon, QMouseEvent, QKeyEvent
+from PyQt6.QtWebEngineCore import QWebEngineProfile, QWebEnginePage
+from PyQt6.QtGui import QAction, QIcon, QMouseEvent, QKeyEvent, QWheelEvent, QImage
 
-# --- Flask Server Setup ---
-latest_screenshot_bytes = None
-screenshot_lock = threading.Lock()
-command_queue = queue.Queue()
+from tiles import TileEncoder
+from frame_codecs import CODECS, DEFAULT_CODEC, TILE_CODEC
+from request_filter import request_filter
+from governor import (MemoryGovernor, process_rss_mb, MEMORY_PRESSURE_MB, MEMORY_RESTART_MB,
+                      PAGE_HEAP_LIMIT_MB)
+from recorder import RECORD_DIR, SessionRecorder, open_recording, replay
+from abr import AdaptiveBitrate
+from cdp import CdpScreencast, DEVTOOLS_PORT
+from async_server import AsyncFrontend, run_async_server
+import metrics
+from streaming import (JPEG_QUALITY, ADAPTIVE_BITRATE, STREAM_KEEPALIVE_SECONDS, WS_TILES,
+                       WS_CODEC, ENCODER_WORKERS, Frame, FrameBroadcaster, FrameEncoder, client_variant,
+                       requested_size, requested_codec, to_view, parse_input_event, decode_input, mjpeg_part)
+
+# "mjpeg" streams full frames; "tiles" streams only the tiles that changed
+# (/stream.tiles). /stream.mjpeg keeps working in both modes.
+STREAM_MODE = os.environ.get("STREAM_MODE", "mjpeg")
+
+# --- Capture Scheduling ---
+# "grab" renders the view with QWidget.grab() and encodes it ourselves;
+# "cdp" takes Chromium's own screencast over the DevTools port
+CAPTURE_BACKEND = os.environ.get("CAPTURE_BACKEND", "grab")
+# "events" grabs only after the view repaints or loads; "timer" grabs at a fixed rate
+CAPTURE_MODE = os.environ.get("CAPTURE_MODE", "events")
+CAPTURE_MAX_FPS = float(os.environ.get("CAPTURE_MAX_FPS", "10"))
+# Idle pages still get a grab this often (catches anything the events miss)
+CAPTURE_KEEPALIVE_MS = int(os.environ.get("CAPTURE_KEEPALIVE_MS", "2000"))
+
+class CaptureScheduler(QObject):
+    """Schedules a grab whenever the view repaints or loads, capped at max_fps."""
+
+    def __init__(self, view, capture, max_fps=CAPTURE_MAX_FPS, keepalive_ms=CAPTURE_KEEPALIVE_MS):
+        super().__init__(view)
+        self._view = view
+        self._capture = capture
+        self._interval_ms = int(1000 / max_fps)
+        self._last_capture_ms = None
+        self._grabbing = False
+        self._paused = False
+        self._watched = None
+
+        self._clock = QElapsedTimer()
+        self._clock.start()
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._fire)
+
+        self._keepalive = QTimer(self)
+        self._keepalive.timeout.connect(self.request)
+        self._keepalive.start(keepalive_ms)
+
+        view.installEventFilter(self)
+        view.loadProgress.connect(self.request)
+        view.loadFinished.connect(self.request)
+        self._watch_render_widget()
+
+    def _watch_render_widget(self):
+        # Chromium paints into a child widget (the focus proxy) that can be
+        # replaced on navigation, so re-attach whenever it changes
+        target = self._view.focusProxy()
+        if target is not None and target is not self._watched:
+            target.installEventFilter(self)
+            self._watched = target
+
+    def eventFilter(self, obj, event):
+        kind = event.type()
+        if kind in (QEvent.Type.Paint, QEvent.Type.Resize):
+            # grab() repaints the widget itself; don't let that re-trigger us
+            if not self._grabbing:
+                self.request()
+        elif kind == QEvent.Type.ChildAdded and obj is self._view:
+            QTimer.singleShot(0, self._watch_render_widget)
+        return False
+
+    def request(self, *args):
+        """Ask for a grab as soon as the FPS cap allows. Extra requests coalesce."""
+        if self._paused or self._timer.isActive():
+            return
+        delay = 0
+        if self._last_capture_ms is not None:
+            since = self._clock.elapsed() - self._last_capture_ms
+            delay = max(0, self._interval_ms - since)
+        self._timer.start(delay)
+
+    def _fire(self):
+        self._last_capture_ms = self._clock.elapsed()
+        self._grabbing = True
+        try:
+            captured = self._capture()
+        finally:
+            self._grabbing = False
+        # Dropped because the encoders were busy: try again next interval
+        if not captured:
+            self.request()
+
+    def pause(self):
+        """Stop grabbing (the page is frozen or hidden) until resume()."""
+        self._paused = True
+        self._keepalive.stop()
+        self._timer.stop()
+
+    def resume(self):
+        self._paused = False
+        self._keepalive.start()
+        self.request()
+
+# Bounds for /viewport resizes
+MIN_VIEW_SIZE = 200
+MAX_VIEW_SIZE = 3840
+
+# --- Input Queue ---
+# Commands: ('click', x, y), ('type', key), ('navigate', url), ('resize', w, h),
+# ('down'|'up', x, y, button), ('move', x, y, buttons), ('wheel', x, y, dx, dy).
+# button/buttons use the DOM MouseEvent numbering (button 0/1/2, buttons bitmask).
+POINTER_COMMANDS = ('move', 'wheel')
+# At most one coalesced pointer event reaches Qt per captured frame
+POINTER_INTERVAL = 1.0 / CAPTURE_MAX_FPS
+
+class InputQueue(QObject):
+    """Thread-safe command queue that wakes the GUI thread as soon as input arrives.
 
+    Consecutive moves collapse into the newest one and consecutive wheel
+    events are summed while they wait, so fast pointer movement can't flood
+    the Qt event loop.
+    """
+
+    wake = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._wake_pending = False
+        self._holding = False
+        self._pointer_due = 0.0
+        # When the oldest queued command arrived (None while empty)
+        self._since = None
+        # Arrival time of the oldest command in the last non-empty drain()
+        self.drained_since = None
+
+    def put(self, command):
+        with self._lock:
+            if self._since is None:
+                self._since = time.monotonic()
+            last = self._pending[-1] if self._pending else None
+            if last and last[0] == command[0] == 'move' and last[3] == command[3]:
+                self._pending[-1] = command
+            elif last and last[0] == command[0] == 'wheel':
+                self._pending[-1] = ('wheel', command[1], command[2],
+                                     last[3] + command[3], last[4] + command[4])
+            else:
+                self._pending.append(command)
+
+            # One wake-up per drain; anything but a pointer event also cuts a hold short
+            if self._wake_pending and not (self._holding and command[0] not in POINTER_COMMANDS):
+                return
+            self._wake_pending = True
+            self._holding = False
+        self.wake.emit()
+
+    def qsize(self):
+        with self._lock:
+            return len(self._pending)
+
+    def age(self):
+        """Seconds the oldest queued command has been waiting."""
+        since = self._since
+        return time.monotonic() - since if since is not None else 0.0
+
+    def drain(self):
+        """Takes every queued command. Returns (commands, seconds to wait or None).
+
+        If only pointer events are queued and one was already dispatched this
+        frame, nothing is returned and the caller should retry after the wait.
+        """
+        now = time.monotonic()
+        with self._lock:
+            pointer_only = all(cmd[0] in POINTER_COMMANDS for cmd in self._pending)
+            if self._pending and pointer_only and now < self._pointer_due:
+                self._holding = True
+                return [], self._pointer_due - now
+
+            commands = list(self._pending)
+            self._pending.clear()
+            self._wake_pending = False
+            self._holding = False
+            if any(cmd[0] in POINTER_COMMANDS for cmd in commands):
+                self._pointer_due = now + POINTER_INTERVAL
+            if commands:
+                self.drained_since = self._since
+                metrics.INPUT_QUEUE_DELAY.observe(now - self._since)
+            self._since = None
+            return commands, None
+
+# DOM MouseEvent.button -> Qt button
+DOM_BUTTONS = {
+    0: Qt.MouseButton.LeftButton,
+    1: Qt.MouseButton.MiddleButton,
+    2: Qt.MouseButton.RightButton,
+}
+
+def dom_buttons(mask):
+    """DOM MouseEvent.buttons bitmask -> Qt buttons."""
+    buttons = Qt.MouseButton.NoButton
+    if mask & 1:
+        buttons |= Qt.MouseButton.LeftButton
+    if mask & 2:
+        buttons |= Qt.MouseButton.RightButton
+    if mask & 4:
+        buttons |= Qt.MouseButton.MiddleButton
+    return buttons
+
+# --- Flask Server Setup ---
 flask_app = Flask(__name__)
 
-@flask_app.route('/')
-def index():
-    return render_template('index.html')
-
-def generate_mjpeg():
-    """Generator for MJPEG stream."""
-    while True:
-        with screenshot_lock:
-            data = latest_screenshot_bytes
-        
-        if data:
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + data + b'\r\n')
-        
-        # Limit server-side FPS
-        import time
-        time.sleep(0.1)
-
-@flask_app.route('/stream.mjpeg')
-def stream():
-    return Response(generate_mjpeg(), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-@flask_app.route('/click', methods=['GET', 'POST'])
-def click():
+def session_route(rule, **options):
+    """Registers a view at rule for the default session and at /s/<sid>/rule.
+
+    The view is called with the Session as its first argument.
+    """
+    def decorator(view):
+        @wraps(view)
+        def handler(sid=DEFAULT_SESSION, **kwargs):
+            try:
+                session = sessions.get(sid)
+            except KeyError:
+                return "No such session", 404
+            except SessionLimitError as e:
+                return str(e), 503
+            return view(session, **kwargs)
+        flask_app.add_url_rule(rule, view_func=handler, **options)
+        flask_app.add_url_rule('/s/<sid>' + rule, view_func=handler, **options)
+        return handler
+    return decorator
+
+@session_route('/')
+def index(session):
+    base = '' if session.id == DEFAULT_SESSION else f'/s/{session.id}'
+    return render_template('index.html', stream_mode=STREAM_MODE, base=base, tile_mime=TILE_CODEC.mime)
+
+@flask_app.route('/new')
+def new_session():
+    """Opens a fresh private session and sends the client to it."""
+    return redirect(f'/s/{secrets.token_urlsafe(8)}/')
+
+@flask_app.route('/sessions')
+def list_sessions():
+    return {'sessions': sessions.describe(), 'rss_mb': round(process_rss_mb())}
+
+@flask_app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@flask_app.route('/healthz')
+def healthz():
+    health = sessions.health()
+    return health, 200 if health['ok'] else 503
+
+# --- Recordings (RECORD_DIR) ---
+# Readable after a session closes too, so these take the id, not a Session.
+# ?t= is a wall-clock timestamp; seeking to it reads only the index.
+
+def request_float(name, default):
+    value = request.args.get(name)
+    return default if value is None else float(value)
+
+@flask_app.route('/recordings/<sid>')
+def recording_summary(sid):
+    try:
+        with open_recording(sid) as reader:
+            return reader.summary()
+    except FileNotFoundError:
+        return "No such recording", 404
+
+@flask_app.route('/recordings/<sid>/frame')
+def recording_frame(sid):
+    try:
+        t = request_float('t', 0.0)
+        with open_recording(sid) as reader:
+            found = reader.frame_at(t)
+    except ValueError:
+        return "Invalid timestamp", 400
+    except FileNotFoundError:
+        return "No such recording", 404
+    if found is None:
+        return "No frame recorded at or before that time", 404
+    timestamp, codec_name, data = found
+    return Response(data, mimetype=CODECS[codec_name].mime, headers={'X-Timestamp': repr(timestamp)})
+
+@flask_app.route('/recordings/<sid>/inputs')
+def recording_inputs(sid):
+    try:
+        start, end = request_float('from', 0.0), request_float('to', float('inf'))
+        with open_recording(sid) as reader:
+            inputs = reader.inputs_between(start, end)
+    except ValueError:
+        return "Invalid timestamp", 400
+    except FileNotFoundError:
+        return "No such recording", 404
+    return {'inputs': [{'t': t, 'commands': commands} for t, commands in inputs]}
+
+def generate_replay(reader, start, speed):
+    try:
+        for wait, codec_name, data in replay(reader, start, speed):
+            time.sleep(wait)
+            yield mjpeg_part(CODECS[codec_name].mime, data)
+    finally:
+        reader.close()
+
+@flask_app.route('/recordings/<sid>/replay.mjpeg')
+def recording_replay(sid):
+    try:
+        start, speed = request_float('t', 0.0), request_float('speed', 1.0)
+        if speed <= 0:
+            raise ValueError(speed)
+        reader = open_recording(sid)
+    except ValueError:
+        return "Invalid timestamp or speed", 400
+    except FileNotFoundError:
+        return "No such recording", 404
+    return Response(generate_replay(reader, start, speed), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+def generate_mjpeg(session, requested=(0, 0), codec=DEFAULT_CODEC):
+    """Generator for MJPEG stream, sized to fit the requested (w, h) box."""
+    frames = session.frames
+    abr = AdaptiveBitrate() if ADAPTIVE_BITRATE else None
+    with session.attached(), frames.viewer():
+        seq = 0
+        while not session.closed:
+            if abr:
+                abr.pace()
+            seq, frame = frames.wait_for_frame(seq, timeout=STREAM_KEEPALIVE_SECONDS)
+            if frame is None:
+                continue
+            # Shared with every other client on the same variant; never copied here
+            part = frame.mjpeg_part(*client_variant(frame, abr, requested), codec=codec)
+
+            # The generator resumes once the server has written the part, so
+            # this measures how fast the client is draining its socket
+            start = time.monotonic()
+            yield part
+            elapsed = time.monotonic() - start
+            metrics.record_send(len(part), elapsed)
+            if abr:
+                abr.sent(len(part), elapsed)
+
+@session_route('/stream.mjpeg')
+def stream(session):
+    # ?w=&h= ask for frames that fit a box (e.g. a phone screen) instead of full size;
+    # ?codec=webp,jpeg picks the image format (first one offered wins)
+    return Response(generate_mjpeg(session, requested_size(request.args), requested_codec(request.args)),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+def generate_tiles(session):
+    """Generator for the tile delta stream (length-prefixed binary messages)."""
+    seq = 0
+    with session.attached():
+        while not session.closed:
+            seq, message = session.tile_encoder.wait_for_delta(seq, timeout=STREAM_KEEPALIVE_SECONDS)
+            if message:
+                start = time.monotonic()
+                yield message
+                metrics.record_send(len(message), time.monotonic() - start)
+
+@session_route('/stream.tiles')
+def stream_tiles(session):
+    if session.tile_encoder is None:
+        return "Tile streaming is disabled (set STREAM_MODE=tiles)", 404
+    return Response(generate_tiles(session), mimetype='application/octet-stream')
+
+@session_route('/click', methods=['GET', 'POST'])
+def click(session):
     try:
-        x = int(request.args.get('x'))
-        y = int(request.args.get('y'))
-        command_queue.put(('click', x, y))
+        # fw/fh: size of the (possibly downscaled) frame the client clicked on
+        x, y = to_view(session.frames.view_size(), request.args.get('x'), request.args.get('y'),
+                       request.args.get('fw'), request.args.get('fh'))
+        session.commands.put(('click', x, y))
         return "Clicked", 200
     except Exception as e:
         return str(e), 400
 
-@flask_app.route('/type', methods=['GET', 'POST'])
-def type_key():
+@session_route('/type', methods=['GET', 'POST'])
+def type_key(session):
     try:
         key = request.args.get('key')
-        command_queue.put(('type', key))
+        session.commands.put(('type', key))
         return "Typed", 200
     except Exception as e:
         return str(e), 400
 
-@flask_app.route('/navigate', methods=['GET', 'POST'])
-def navigate():
+@session_route('/navigate', methods=['GET', 'POST'])
+def navigate(session):
     try:
         url = request.args.get('url')
-        command_queue.put(('navigate', url))
+        session.commands.put(('navigate', url))
         return "Navigating", 200
     except Exception as e:
         return str(e), 400
 
+@session_route('/viewport', methods=['GET', 'POST'])
+def viewport(session):
+    """Reports the view size; with ?w=&h= resizes the view first (affects every client)."""
+    try:
+        if request.args.get('w'):
+            session.commands.put(('resize', int(request.args['w']), int(request.args['h'])))
+    except Exception as e:
+        return str(e), 400
+    width, height = session.frames.view_size()
+    return {'width': width, 'height': height}
+
+@session_route('/input', methods=['POST'])
+def input_batch(session):
+    """Batch input: {"events": [{"type": "move", "x": 10, "y": 20}, ...]}, applied in order."""
+    try:
+        view_size = session.frames.view_size()
+        commands = [parse_input_event(event, view_size) for event in request.get_json()['events']]
+    except Exception as e:
+        return str(e), 400
+    for command in commands:
+        session.commands.put(command)
+    return "Queued", 200
+
+# --- WebSocket Channel ---
+sock = Sock(flask_app)
+
+def pump_frames(ws, session, client):
+    """Sends frames to one websocket client until it goes away.
+
+    client['size'] is the (w, h) box the client asked for; it may change
+    while streaming. client['codec'] is the codec it negotiated.
+    """
+    seq = 0
+    abr = AdaptiveBitrate() if ADAPTIVE_BITRATE else None
+    try:
+        if session.tile_encoder is None:
+            ws.send(bytes([WS_CODEC]) + client['codec'].name.encode())
+        while ws.connected and not session.closed:
+            if session.tile_encoder is not None:
+                seq, message = session.tile_encoder.wait_for_delta(seq, timeout=STREAM_KEEPALIVE_SECONDS)
+                if message:
+                    start = time.monotonic()
+                    ws.send(bytes([WS_TILES]) + message)
+                    metrics.record_send(len(message) + 1, time.monotonic() - start)
+                continue
+
+            if abr:
+                abr.pace()
+            seq, frame = session.frames.wait_for_frame(seq, timeout=STREAM_KEEPALIVE_SECONDS)
+            if frame is None:
+                continue
+            message = frame.ws_message(*client_variant(frame, abr, client['size']), codec=client['codec'])
+            start = time.monotonic()
+            ws.send(message)
+            elapsed = time.monotonic() - start
+            metrics.record_send(len(message), elapsed)
+            if abr:
+                abr.sent(len(message), elapsed)
+    except ConnectionClosed:
+        pass
+
+@sock.route('/ws')
+def ws_channel(ws):
+    serve_socket(ws, DEFAULT_SESSION)
+
+@sock.route('/s/<sid>/ws', endpoint='session_ws_channel')
+def session_ws_channel(ws, sid):
+    serve_socket(ws, sid)
+
+def serve_socket(ws, sid):
+    try:
+        session = sessions.get(sid)
+    except (KeyError, SessionLimitError) as e:
+        ws.close(reason=1008, message=str(e))
+        return
+    client = {'size': requested_size(request.args), 'codec': requested_codec(request.args)}
+
+    with session.attached():
+        # Frames go out on their own thread so a slow frame send never delays input
+        threading.Thread(target=pump_frames, args=(ws, session, client), daemon=True).start()
+
+        last_seq = 0
+        while not session.closed:
+            msg = ws.receive()
+            if not isinstance(msg, bytes):
+                continue
+            try:
+                seq, command = decode_input(msg)
+            except Exception as e:
+                print(f"Bad input message: {e}")
+                continue
+            # Events are applied strictly in seq order; stale or duplicate ones are dropped
+            if seq <= last_seq:
+                continue
+            last_seq = seq
+            if command[0] == 'viewport':
+                client['size'] = command[1:]
+            else:
+                session.commands.put(command)
+
+# "flask" runs the Werkzeug thread-per-request server; "async" serves the same
+# routes from one asyncio loop (async_server.py) so viewers cost coroutines, not threads
+SERVER_MODE = os.environ.get("SERVER_MODE", "flask")
+# router.py gives every worker its own port
+SERVER_PORT = int(os.environ.get("PORT", "5000"))
+
 def run_server():
-    flask_app.run(port=5000, host='0.0.0.0', debug=False, use_reloader=False)
+    if SERVER_MODE == "async":
+        run_async_server(AsyncFrontend(sessions, STREAM_MODE, SessionLimitError), port=SERVER_PORT)
+    else:
+        flask_app.run(port=SERVER_PORT, host='0.0.0.0', debug=False, use_reloader=False)
 
 # --------------------------
 
+# --- Profiles and Warm Views ---
+# PROFILE_DIR keeps the default session's cookies, storage and HTTP/code
+# cache on disk, so restarts don't start cold. Other sessions always get a
+# private off-the-record profile and never share anything. Only one process
+# may use a profile directory; router.py gives each worker its own.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+# Upper bound for the on-disk HTTP cache
+PROFILE_CACHE_MB = int(os.environ.get("PROFILE_CACHE_MB", "256"))
+# Private views kept initialized on about:blank, ready for new sessions
+WARM_VIEWS = int(os.environ.get("WARM_VIEWS", "1"))
+# Refill the pool this long after taking a view, so it doesn't slow that session's first paint
+WARM_REFILL_MS = 2000
+
+_persistent_profile = None
+
+def persistent_profile():
+    """The shared on-disk profile (GUI thread only), created on first use."""
+    global _persistent_profile
+    if _persistent_profile is None:
+        profile = QWebEngineProfile("browser", QApplication.instance())
+        profile.setPersistentStoragePath(os.path.join(PROFILE_DIR, "storage"))
+        profile.setCachePath(os.path.join(PROFILE_DIR, "cache"))
+        profile.setHttpCacheType(QWebEngineProfile.HttpCacheType.DiskHttpCache)
+        profile.setHttpCacheMaximumSize(PROFILE_CACHE_MB * 1024 * 1024)
+        profile.setPersistentCookiesPolicy(QWebEngineProfile.PersistentCookiesPolicy.AllowPersistentCookies)
+        _persistent_profile = profile
+    return _persistent_profile
+
+def create_view(profile=None):
+    """A (profile, page, view) triple on about:blank; profile=None makes a private one."""
+    profile = profile or QWebEngineProfile()
+    profile.setUrlRequestInterceptor(request_filter())
+    view = QWebEngineView()
+    page = QWebEnginePage(profile, view)
+    view.setPage(page)
+    view.setUrl(QUrl("about:blank"))
+    return profile, page, view
+
+class ViewPool:
+    """Private views created ahead of time (GUI thread only).
+
+    Creating a view and its renderer is most of a new session's start-up;
+    a parked view only has to navigate.
+    """
+
+    def __init__(self, size=WARM_VIEWS):
+        self.size = size
+        self._views = deque()
+
+    def fill(self):
+        while len(self._views) < self.size:
+            self._views.append(create_view())
+
+    def take(self):
+        parked = self._views.popleft() if self._views else create_view()
+        QTimer.singleShot(WARM_REFILL_MS, self.fill)
+        return parked
+
+    def clear(self):
+        """Drops every parked view (memory pressure)."""
+        while self._views:
+            profile, page, view = self._views.popleft()
+            page.deleteLater()
+            view.deleteLater()
+            profile.deleteLater()
+
 class WebBrowser(QMainWindow):
-    def __init__(self):
+    """The Qt side of one session: a view on its own profile, plus capture and input."""
+
+    def __init__(self, session, capture_backend=CAPTURE_BACKEND, parked=None, url=None):
         super().__init__()
+        self.session = session
 
-        self.setWindowTitle("Quick Browser")
+        self.setWindowTitle(f"Quick Browser [{session.id}]")
         self.setGeometry(100, 100, 1024, 768)
 
-        # Create the web engine view
-        self.browser = QWebEngineView()
-        
-        import os
-        self.browser.setUrl(QUrl("https://www.google.com"))
-        
+        # The view comes from the warm pool or create_view(); without one it
+        # gets a private off-the-record profile, so sessions never share
+        # cookies, storage or cache
+        self.profile, self.page, self.browser = parked or create_view()
+        self.owns_profile = self.profile is not _persistent_profile
+        # Read once here; the page's DevTools target is looked up from other threads
+        self.devtools_id = self.page.devToolsId()
+        self.browser.setUrl(QUrl(url or START_URL))
+
         # Connect urlChanged signal
         self.browser.urlChanged.connect(self.update_url_bar)
-        
+
         # Set the central widget
         self.setCentralWidget(self.browser)
 
         # URL Bar Helper (Hidden logic)
         self.url_tracker = ""
 
-        # Start Screenshot Timer - FASTER for video
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.capture_screen)
-        self.timer.start(100) # Capture every 100ms (10 FPS)
+        # Encoder pool (grab happens here, JPEG encoding on worker threads)
+        self.encoder = FrameEncoder(session.frames, tiles=session.tile_encoder, pool=encoder_pool,
+                                    sequence=session.capture_seq, recording=session.recorder is not None)
+
+        # Start Screen Capture
+        self.screencast = self.timer = self.capture_scheduler = None
+        if capture_backend == "cdp":
+            self.screencast = CdpScreencast(self.publish_screencast_frame, self.devtools_id,
+                                            port=DEVTOOLS_PORT, quality=JPEG_QUALITY)
+            self.screencast.start()
+        elif CAPTURE_MODE == "timer":
+            self.timer = QTimer()
+            self.timer.timeout.connect(self.capture_screen)
+            self.timer.start(int(1000 / CAPTURE_MAX_FPS))
+        else:
+            self.capture_scheduler = CaptureScheduler(self.browser, self.capture_screen)
+
+        # Input wakes the GUI thread directly (queued signal from the server threads)
+        self.input_timer = QTimer()
+        self.input_timer.setSingleShot(True)
+        self.input_timer.timeout.connect(self.process_commands)
+        session.commands.wake.connect(self.process_commands)
+        # Input that arrived while the view was being created
+        QTimer.singleShot(0, self.process_commands)
+
+    def suspend(self, state):
+        """Freeze or discard the page. Only hidden pages may leave the Active state."""
+        if self.capture_scheduler:
+            self.capture_scheduler.pause()
+        elif self.timer:
+            self.timer.stop()
+        self.hide()
+        self.page.setLifecycleState(state)
 
-        # Start Command Processing
-        self.cmd_timer = QTimer()
-        self.cmd_timer.timeout.connect(self.process_commands)
-        self.cmd_timer.start(50)
+    def wake(self):
+        # A discarded page reloads its last URL here
+        self.page.setLifecycleState(QWebEnginePage.LifecycleState.Active)
+        self.show()
+        if self.capture_scheduler:
+            self.capture_scheduler.resume()
+        elif self.timer:
+            self.timer.start()
 
-        # Start Server Thread
-        print("Starting Flask Server...")
-        server_thread = threading.Thread(target=run_server, daemon=True)
-        server_thread.start()
+    def shutdown(self, keep_profile=False):
+        """Closes the window. keep_profile leaves the profile alive for a replacement view."""
+        if self.screencast:
+            self.screencast.stop()
+        if self.timer:
+            self.timer.stop()
+        self.input_timer.stop()
+        self.session.commands.wake.disconnect(self.process_commands)
+        self.close()
+        # The page has to go before the profile it was created on
+        self.page.deleteLater()
+        if self.owns_profile and not keep_profile:
+            self.profile.deleteLater()
+        self.deleteLater()
+
+    def input_target(self):
+        # Chromium receives input on its render widget (the focus proxy)
+        return self.browser.focusProxy() or self.browser
+
+    def send_mouse(self, kind, x, y, button, buttons):
+        pt = QPointF(float(x), float(y))
+        # PyQt6 QMouseEvent constructor requires careful argument matching
+        # (type, localPos, globalPos, button, buttons, modifiers)
+        event = QMouseEvent(kind, pt, pt, button, buttons, Qt.KeyboardModifier.NoModifier)
+        QApplication.sendEvent(self.input_target(), event)
 
     def process_commands(self):
-        try:
-            while not command_queue.empty():
-                cmd, *args = command_queue.get_nowait()
-                if cmd == 'navigate':
-                    url = args[0]
-                    if not url.startswith('http'):
-                        url = 'https://' + url
-                    self.browser.setUrl(QUrl(url))
-                
-                elif cmd == 'click':
-                    x, y = args
-                    pt = QPointF(float(x), float(y))
-                    
-                    target = self.browser.focusProxy()
-                    if not target:
-                        target = self.browser
-                    
-                    # PyQt6 QMouseEvent constructor requires careful argument matching
-                    # (type, localPos, globalPos, button, buttons, modifiers)
-                    
-                    event_press = QMouseEvent(
-                        QEvent.Type.MouseButtonPress, 
-                        pt, 
-                        pt, # globalPos (using local is often fine for single window)
-                        Qt.MouseButton.LeftButton, 
-                        Qt.MouseButton.LeftButton, 
-                        Qt.KeyboardModifier.NoModifier
-                    )
-                    QApplication.sendEvent(target, event_press)
-                    
-                    event_release = QMouseEvent(
-                        QEvent.Type.MouseButtonRelease, 
-                        pt, 
-                        pt,
-                        Qt.MouseButton.LeftButton, 
-                        Qt.MouseButton.LeftButton, 
-                        Qt.KeyboardModifier.NoModifier
-                    )
-                    QApplication.sendEvent(target, event_release)
-                
-                elif cmd == 'type':
-                    key_str = args[0]
-                    # Simplified key injection
-                    # You might need a more robust mapping for complex keys
-                    key_code = 0
-                    if len(key_str) == 1:
-                        key_code = ord(key_str.upper())
-                    
-                    if key_str == 'Enter': key_code = Qt.Key.Key_Return
-                    if key_str == 'Backspace': key_code = Qt.Key.Key_Backspace
-
-                    target = self.browser.focusProxy()
-                    if not target: target = self.browser
-
-                    event = QKeyEvent(QEvent.Type.KeyPress, key_code, Qt.KeyboardModifier.NoModifier, key_str)
-                    QApplication.sendEvent(target, event)
-                    
-                    event = QKeyEvent(QEvent.Type.KeyRelease, key_code, Qt.KeyboardModifier.NoModifier, key_str)
-                    QApplication.sendEvent(target, event)
-
-
-        except queue.Empty:
-            pass
+        commands, retry = self.session.commands.drain()
+        if retry is not None:
+            # Pointer events already went out this frame; pick the rest up next frame
+            self.input_timer.start(int(retry * 1000) + 1)
+
+        for cmd, *args in commands:
+            if cmd == 'navigate':
+                url = args[0]
+                if not url.startswith('http'):
+                    url = 'https://' + url
+                self.browser.setUrl(QUrl(url))
+
+            elif cmd == 'resize':
+                width, height = args
+                # The view is the only widget in the window, so it takes the whole size
+                self.resize(max(MIN_VIEW_SIZE, min(width, MAX_VIEW_SIZE)),
+                            max(MIN_VIEW_SIZE, min(height, MAX_VIEW_SIZE)))
+
+            elif cmd == 'click':
+                x, y = args
+                left = Qt.MouseButton.LeftButton
+                self.send_mouse(QEvent.Type.MouseButtonPress, x, y, left, left)
+                self.send_mouse(QEvent.Type.MouseButtonRelease, x, y, left, left)
+
+            elif cmd in ('down', 'up'):
+                x, y, button = args
+                qt_button = DOM_BUTTONS.get(button, Qt.MouseButton.LeftButton)
+                if cmd == 'down':
+                    self.send_mouse(QEvent.Type.MouseButtonPress, x, y, qt_button, qt_button)
+                else:
+                    self.send_mouse(QEvent.Type.MouseButtonRelease, x, y, qt_button, Qt.MouseButton.NoButton)
+
+            elif cmd == 'move':
+                x, y, buttons = args
+                self.send_mouse(QEvent.Type.MouseMove, x, y, Qt.MouseButton.NoButton, dom_buttons(buttons))
+
+            elif cmd == 'wheel':
+                x, y, dx, dy = args
+                pt = QPointF(float(x), float(y))
+                # DOM deltas are positive scrolling down/right; Qt's are the opposite
+                delta = QPoint(-dx, -dy)
+                event = QWheelEvent(pt, pt, delta, delta, Qt.MouseButton.NoButton,
+                                    Qt.KeyboardModifier.NoModifier, Qt.ScrollPhase.NoScrollPhase, False)
+                QApplication.sendEvent(self.input_target(), event)
+
+            elif cmd == 'type':
+                key_str = args[0]
+                # Simplified key injection
+                # You might need a more robust mapping for complex keys
+                key_code = 0
+                if len(key_str) == 1:
+                    key_code = ord(key_str.upper())
+
+                if key_str == 'Enter': key_code = Qt.Key.Key_Return
+                if key_str == 'Backspace': key_code = Qt.Key.Key_Backspace
+
+                target = self.input_target()
+
+                event = QKeyEvent(QEvent.Type.KeyPress, key_code, Qt.KeyboardModifier.NoModifier, key_str)
+                QApplication.sendEvent(target, event)
+
+                event = QKeyEvent(QEvent.Type.KeyRelease, key_code, Qt.KeyboardModifier.NoModifier, key_str)
+                QApplication.sendEvent(target, event)
+
+        if commands:
+            # The first frame captured from now on is the one that shows this input
+            self.session.frames.mark_input(self.session.commands.drained_since, time.monotonic())
+            if self.session.recorder is not None:
+                self.session.recorder.record_input(commands)
 
     def capture_screen(self):
-        # Capture strictly the browser Viewport (web content)
-        pixmap = self.browser.grab()
-        
-        # Save to JPG (Lower quality to 30 for speed/latency)
-        buffer = QBuffer()
-        buffer.open(QIODevice.OpenModeFlag.ReadWrite)
-        pixmap.save(buffer, "JPG", quality=30)
-        
-        data = buffer.data().data()
-        
-        global latest_screenshot_bytes
-        with screenshot_lock:
-            latest_screenshot_bytes = data
-            
+        # Capture strictly the browser Viewport (web content).
+        # QPixmap is GUI-thread only; QImage can be handed to the encoder threads.
+        # If all encoders are busy the frame is dropped before paying for the grab.
+        return self.encoder.submit(lambda: self.browser.grab().toImage())
+
+    def publish_screencast_frame(self, data):
+        # Runs on the screencast thread; Chromium already sent a JPEG
+        image = None
+        tiles = self.session.tile_encoder
+        if tiles is not None:
+            image = QImage.fromData(data, "JPG")
+            tiles.update(next(self.session.capture_seq), image)
+        self.session.frames.publish(Frame(data, image))
+
     def update_url_bar(self, q):
         self.url_tracker = q.toString()
 
+# --- Sessions ---
+# Each session is its own browser: a view on a private profile with its own
+# frame stream and input queue. /s/<id>/... addresses a session; the
+# unprefixed routes use the default one. Sessions open on first request.
+DEFAULT_SESSION = "default"
+SESSION_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+# Overridable so benchmarks can start on a local fixture page
+START_URL = os.environ.get("START_URL", "https://www.google.com")
+# Open the default session at start-up instead of on its first request.
+# router.py turns this off: only the worker the default session hashes to needs it
+OPEN_DEFAULT_SESSION = os.environ.get("OPEN_DEFAULT_SESSION", "1") == "1"
+# Live views at most; opening another closes the least recently used idle one
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "4"))
+# Sessions nobody has watched or sent input to for this long are frozen
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "60"))
+# A new session can't be evicted this soon, before its first viewer has attached
+SESSION_OPEN_GRACE_SECONDS = 15
+# Above this resident size idle sessions are discarded, then closed, least recently used first
+SESSION_MEMORY_LIMIT_MB = int(os.environ.get("SESSION_MEMORY_LIMIT_MB", "2048"))
+SESSION_CHECK_MS = 5000
+# /healthz fails once the GUI thread hasn't run a session check for this long
+HEALTH_STALL_SECONDS = 3 * SESSION_CHECK_MS / 1000
+
+encoder_pool = ThreadPoolExecutor(max_workers=max(ENCODER_WORKERS, os.cpu_count() or 1),
+                                  thread_name_prefix="encoder")
+
+def _input_queues():
+    return [session.commands for session in sessions.all()]
+
+metrics.INPUT_QUEUE_DEPTH.callback = lambda: sum(queue.qsize() for queue in _input_queues())
+metrics.INPUT_QUEUE_AGE.callback = lambda: max((queue.age() for queue in _input_queues()), default=0.0)
+
+class SessionLimitError(Exception):
+    pass
+
+class Session:
+    """One session's shared state.
+
+    The window is created later on the GUI thread; until then input queues
+    up and stream clients wait for the first frame.
+    """
+
+    def __init__(self, sid):
+        self.id = sid
+        self.frames = FrameBroadcaster()
+        self.tile_encoder = TileEncoder(quality=JPEG_QUALITY, codec=TILE_CODEC) if STREAM_MODE == "tiles" else None
+        self.commands = InputQueue()
+        # Server threads come and go; the queue belongs to the GUI thread
+        self.commands.moveToThread(QApplication.instance().thread())
+        # Capture sequence numbers, kept across view restarts: the tile
+        # encoder drops any frame numbered at or below its last one
+        self.capture_seq = itertools.count(1)
+        self.window = None
+        # 'opening' -> 'active' <-> 'frozen' / 'discarded', then 'closed'
+        self.state = 'opening'
+        self.clients = 0
+        self.opened_at = self.last_active = time.monotonic()
+        self._lock = threading.Lock()
+        self.recorder = None
+        if RECORD_DIR:
+            self.recorder = SessionRecorder(os.path.join(RECORD_DIR, sid))
+            self.frames.add_listener(self._record_frame)
+
+    def _record_frame(self):
+        seq, frame = self.frames.wait_for_frame(0, timeout=0)
+        self.recorder.record_frame(seq, frame, frame.codec.name)
+
+    @property
+    def closed(self):
+        return self.state == 'closed'
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def evictable(self):
+        """Whether opening another session may close this one."""
+        return (not self.clients and self.state != 'opening'
+                and time.monotonic() - self.opened_at > SESSION_OPEN_GRACE_SECONDS)
+
+    def idle_for(self):
+        return 0.0 if self.clients else time.monotonic() - self.last_active
+
+    @contextmanager
+    def attached(self):
+        """Counts a stream or socket client for as long as it is connected."""
+        with self._lock:
+            self.clients += 1
+        self.touch()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.clients -= 1
+            self.touch()
+
+class SessionManager(QObject):
+    """Opens sessions on demand and keeps the number and memory of live views bounded.
+
+    get() may be called from any thread; anything touching Qt widgets is
+    handed to the GUI thread through queued signals.
+    """
+
+    _open_requested = pyqtSignal(object)
+    _wake_requested = pyqtSignal(object)
+    _close_requested = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._sessions = OrderedDict()
+        self._open_requested.connect(self._open)
+        self._wake_requested.connect(self._wake)
+        self._close_requested.connect(self._close)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._check)
+        self._timer.start(SESSION_CHECK_MS)
+        self._last_check = time.monotonic()
+
+        # Filled once the first session is under way
+        self.pool = ViewPool()
+        QTimer.singleShot(WARM_REFILL_MS, self.pool.fill)
+        self.governor = MemoryGovernor()
+
+    def get(self, sid):
+        """Returns session sid, opening or waking it as needed.
+
+        Raises KeyError for malformed ids and SessionLimitError when every
+        live view has clients or was only just opened.
+        """
+        if not SESSION_ID.fullmatch(sid):
+            raise KeyError(sid)
+        evicted = None
+        with self._lock:
+            session = self._sessions.get(sid)
+            opening = session is None
+            if opening:
+                if len(self._sessions) >= MAX_SESSIONS:
+                    evicted = next((s for s in self._sessions.values() if s.evictable()), None)
+                    if evicted is None:
+                        raise SessionLimitError(f"All {MAX_SESSIONS} sessions are in use")
+                    del self._sessions[evicted.id]
+                session = Session(sid)
+                self._sessions[sid] = session
+            else:
+                self._sessions.move_to_end(sid)
+        session.touch()
+
+        if evicted is not None:
+            print(f"[sessions] closing idle session {evicted.id} to open {sid}")
+            self._close_requested.emit(evicted)
+        if opening:
+            self._open_requested.emit(session)
+        elif session.state in ('frozen', 'discarded'):
+            self._wake_requested.emit(session)
+        return session
+
+    def all(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def describe(self):
+        sessions = self.all()
+        return [{'id': s.id, 'state': s.state, 'clients': s.clients, 'idle_seconds': round(s.idle_for()),
+                 'js_heap_mb': round(self._heap_mb(s))}
+                for s in sessions]
+
+    def _heap_mb(self, session):
+        window = session.window
+        return self.governor.heap_mb(window.devtools_id) if window is not None else 0.0
+
+    def health(self):
+        """Liveness for /healthz: a hung GUI thread (or renderer) stops the session checks."""
+        stalled = time.monotonic() - self._last_check
+        return {'ok': stalled < HEALTH_STALL_SECONDS, 'sessions': len(self._sessions),
+                'gui_stalled_seconds': round(stalled, 1)}
+
+    def _open(self, session, url=None, profile=None):
+        if session.closed:
+            return
+        if profile is not None:
+            parked = create_view(profile)
+        elif session.id == DEFAULT_SESSION and PROFILE_DIR:
+            parked = create_view(persistent_profile())
+        else:
+            parked = self.pool.take()
+        session.window = WebBrowser(session, parked=parked, url=url)
+        session.window.show() # Must show to render, even in headless env (xvfb handles it)
+        session.state = 'active'
+
+    def _wake(self, session):
+        if session.state in ('frozen', 'discarded'):
+            session.window.wake()
+            session.state = 'active'
+
+    def _close(self, session):
+        session.state = 'closed'
+        if session.window is not None:
+            session.window.shutdown()
+            session.window = None
+        if session.recorder is not None:
+            session.recorder.close()
+
+    def _restart(self, session):
+        """Recreates the session's view on the page it was showing; clients stay connected.
+
+        The new view reuses the session's profile, so cookies and storage
+        (and with them any login) survive.
+        """
+        url = session.window.browser.url().toString() or START_URL
+        profile = session.window.profile
+        print(f"[sessions] restarting the view of session {session.id} ({round(self._heap_mb(session))} MB JS heap)")
+        session.window.shutdown(keep_profile=True)
+        session.window = None
+        metrics.VIEWS_RESTARTED.inc()
+        self.governor.last_restart = time.monotonic()
+        self._open(session, url, profile)
+
+    def _suspend(self, session, state):
+        if state == QWebEnginePage.LifecycleState.Discarded:
+            metrics.PAGES_DISCARDED.inc()
+        session.window.suspend(state)
+        session.state = 'frozen' if state == QWebEnginePage.LifecycleState.Frozen else 'discarded'
+        print(f"[sessions] {session.state} session {session.id}")
+
+    def _check(self):
+        self._last_check = time.monotonic()
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.state == 'active' and session.idle_for() > SESSION_IDLE_SECONDS:
+                self._suspend(session, QWebEnginePage.LifecycleState.Frozen)
+
+        rss = process_rss_mb()
+        if MEMORY_PRESSURE_MB and rss > MEMORY_PRESSURE_MB:
+            self.governor.notify_pressure("critical" if rss > SESSION_MEMORY_LIMIT_MB else "moderate")
+            for session in sessions:
+                if (PAGE_HEAP_LIMIT_MB and not session.clients and session.state in ('active', 'frozen')
+                        and self._heap_mb(session) > PAGE_HEAP_LIMIT_MB):
+                    self._suspend(session, QWebEnginePage.LifecycleState.Discarded)
+        if rss <= SESSION_MEMORY_LIMIT_MB:
+            return
+        if self.pool.size:
+            # Parked views go first, and the pool is not refilled for the rest of the run
+            self.pool.clear()
+            self.pool.size = 0
+            print("[sessions] dropped warm views (memory pressure)")
+            return
+        # Under pressure release one idle session per check, since memory comes
+        # back lazily: discard the least recently used page, else close a discarded one
+        idle = [s for s in sessions if not s.clients and s.state != 'opening']
+        for session in idle:
+            if session.state in ('active', 'frozen'):
+                self._suspend(session, QWebEnginePage.LifecycleState.Discarded)
+                return
+        for session in idle:
+            with self._lock:
+                if self._sessions.get(session.id) is not session or session.clients:
+                    continue
+                del self._sessions[session.id]
+            print(f"[sessions] closing session {session.id} (memory pressure)")
+            self._close(session)
+            return
+
+        # Nothing idle is left to release: restart the view with the biggest heap
+        if MEMORY_RESTART_MB and rss > MEMORY_RESTART_MB and self.governor.may_restart():
+            live = [s for s in sessions if s.state == 'active' and s.window is not None]
+            if live:
+                self._restart(max(live, key=self._heap_mb))
+
 if __name__ == "__main__":
     import os
     # FORCE Software Rendering aggressively
@@ -207,10 +1073,16 @@ if __name__ == "__main__":
         "--disable-software-rasterizer", # sometimes helps? No, we want software.
         "--disable-dev-shm-usage",
         "--single-process",
-        "--remote-debugging-port=9222"
+        f"--remote-debugging-port={DEVTOOLS_PORT}"
     ]
     
     app = QApplication(qt_args)
-    window = WebBrowser()
-    window.show() # Must show to render, even in headless env (xvfb handles it)
+    sessions = SessionManager()
+    if OPEN_DEFAULT_SESSION:
+        sessions.get(DEFAULT_SESSION)
+
+    # Start Server Thread
+    print("Starting Flask Server...")
+    server_thread = threading.Thread(target=run_server, daemon=True)
+    server_thread.start()
     sys.exit(app.exec())
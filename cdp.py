@@ -0,0 +1,130 @@
+import base64
+import json
+import os
+import threading
+import time
+import urllib.request
+
+import websocket  # websocket-client
+
+# Overridden per worker when router.py runs several browsers on one host
+DEVTOOLS_PORT = int(os.environ.get("DEVTOOLS_PORT", "9222"))
+
+
+def page_targets(port=DEVTOOLS_PORT):
+    """[(id, url, webSocketDebuggerUrl)] for every page the DevTools server knows.
+
+    The id is the one QWebEnginePage.devToolsId() reports for the page.
+    """
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/json", timeout=2) as resp:
+        targets = json.load(resp)
+    return [(target.get("id", ""), target.get("url", ""), target["webSocketDebuggerUrl"]) for target in targets
+            if target.get("type") == "page" and target.get("webSocketDebuggerUrl")]
+
+
+def call(ws_url, method, params=None, timeout=2):
+    """Sends one command to a target and returns its result (blocking)."""
+    ws = websocket.create_connection(ws_url, suppress_origin=True, timeout=timeout)
+    try:
+        ws.send(json.dumps({"id": 1, "method": method, "params": params or {}}))
+        while True:
+            msg = json.loads(ws.recv())
+            if msg.get("id") == 1:
+                if "error" in msg:
+                    raise RuntimeError(msg["error"].get("message"))
+                return msg.get("result", {})
+    finally:
+        ws.close()
+
+
+def js_heap_usage(port=DEVTOOLS_PORT):
+    """{target id: used JS heap bytes}. Pages that don't answer in time (frozen) are left out."""
+    usage = {}
+    for target_id, _, ws_url in page_targets(port):
+        try:
+            usage[target_id] = call(ws_url, "Runtime.getHeapUsage")["usedSize"]
+        except Exception:
+            continue
+    return usage
+
+
+def notify_memory_pressure(level="moderate", port=DEVTOOLS_PORT):
+    """Makes every page drop caches and collect garbage as if the OS were low on memory."""
+    for _, _, ws_url in page_targets(port):
+        try:
+            call(ws_url, "Memory.simulatePressureNotification", {"level": level})
+        except Exception:
+            continue
+
+
+class CdpScreencast:
+    """Streams frames from Chromium's Page.startScreencast over the DevTools port.
+
+    Chromium only emits a frame when the page actually changed and sends it
+    already JPEG-compressed, so nothing is grabbed or encoded on our side.
+    target_id is the page's QWebEnginePage.devToolsId(); every session and
+    warm view is a page target of its own. on_frame(data) is called with
+    the JPEG bytes on the screencast thread.
+    """
+
+    def __init__(self, on_frame, target_id, port=DEVTOOLS_PORT, quality=30):
+        self._on_frame = on_frame
+        self._target_id = target_id
+        self._port = port
+        self._quality = quality
+        self._running = False
+        self._ws = None
+        self._next_id = 0
+        self._thread = threading.Thread(target=self._run, name="cdp-screencast", daemon=True)
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        ws = self._ws
+        if ws is not None:
+            ws.close()
+
+    def _page_ws_url(self):
+        for target_id, _, ws_url in page_targets(self._port):
+            if target_id == self._target_id:
+                return ws_url
+        return None
+
+    def _send(self, method, params=None):
+        self._next_id += 1
+        self._ws.send(json.dumps({"id": self._next_id, "method": method, "params": params or {}}))
+
+    def _run(self):
+        # The DevTools server comes up after the first page is created and the
+        # target goes away on renderer crashes, so keep (re)connecting
+        while self._running:
+            try:
+                url = self._page_ws_url()
+                if url:
+                    self._stream(url)
+            except Exception as e:
+                if self._running:
+                    print(f"CDP screencast error: {e}")
+            time.sleep(1)
+
+    def _stream(self, url):
+        # Chromium rejects DevTools websockets that send an Origin header
+        self._ws = websocket.create_connection(url, suppress_origin=True)
+        try:
+            self._send("Page.startScreencast", {"format": "jpeg", "quality": self._quality})
+            while self._running:
+                msg = json.loads(self._ws.recv())
+                method = msg.get("method")
+                if method == "Page.screencastFrame":
+                    params = msg["params"]
+                    # Ack first so Chromium can start on the next frame while we publish
+                    self._send("Page.screencastFrameAck", {"sessionId": params["sessionId"]})
+                    self._on_frame(base64.b64decode(params["data"]))
+                elif method == "Inspector.detached":
+                    break
+        finally:
+            ws, self._ws = self._ws, None
+            ws.close()
@@ -0,0 +1,133 @@
+import io
+import os
+
+import numpy as np
+from PyQt6.QtGui import QImage
+
+from tiles import encode_jpeg
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is only needed for the WebP and PNG codecs
+    Image = features = None
+
+# Frame codecs. Each stream client picks one with ?codec=a,b,... (the first
+# one this deployment offers wins); STREAM_CODECS lists what a deployment
+# offers, and its first entry is what clients get by default and what every
+# captured frame is encoded to up front.
+
+# WebP speed/size trade-off (0 = fastest, 6 = smallest)
+WEBP_METHOD = 2
+# Lossless WebP effort (0-100); higher is smaller and slower
+WEBP_LOSSLESS_EFFORT = 25
+# zlib level for PNG; low levels are far cheaper and still shrink flat, text-heavy pages well
+PNG_COMPRESS_LEVEL = 3
+# Frames with at most this many colours are stored as exact 8-bit palette PNGs
+PALETTE_MAX_COLORS = 256
+
+
+def pil_image(image):
+    """Copy a QImage into an RGB PIL image."""
+    image = image.convertToFormat(QImage.Format.Format_RGB888)
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    return Image.frombuffer('RGB', (image.width(), image.height()), bytes(ptr),
+                            'raw', 'RGB', image.bytesPerLine(), 1)
+
+
+class Codec:
+    """Turns a QImage into one image format. quality is ignored by lossless codecs."""
+
+    name = None
+    mime = None
+    lossless = False
+
+    @property
+    def available(self):
+        return True
+
+    def encode(self, image, quality):
+        raise NotImplementedError
+
+
+class JpegCodec(Codec):
+    name = 'jpeg'
+    mime = 'image/jpeg'
+
+    def encode(self, image, quality):
+        return encode_jpeg(image, quality)
+
+
+class WebpCodec(Codec):
+    """WebP through Pillow: lossy (quality as given) or lossless."""
+
+    mime = 'image/webp'
+
+    def __init__(self, lossless=False):
+        self.lossless = lossless
+        self.name = 'webp-lossless' if lossless else 'webp'
+
+    @property
+    def available(self):
+        return features is not None and features.check('webp')
+
+    def encode(self, image, quality):
+        buffer = io.BytesIO()
+        if self.lossless:
+            pil_image(image).save(buffer, 'WEBP', lossless=True, quality=WEBP_LOSSLESS_EFFORT,
+                                  method=WEBP_METHOD)
+        else:
+            pil_image(image).save(buffer, 'WEBP', quality=quality, method=WEBP_METHOD)
+        return buffer.getvalue()
+
+
+class PngCodec(Codec):
+    """Lossless PNG, as an exact 8-bit palette image when the frame has few colours.
+
+    Text-heavy pages are mostly flat background and a handful of glyph
+    shades, which this keeps pixel-exact at a fraction of a full RGB PNG.
+    """
+
+    name = 'png'
+    mime = 'image/png'
+    lossless = True
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def encode(self, image, quality):
+        pil = pil_image(image)
+        colors = pil.getcolors(PALETTE_MAX_COLORS)
+        if colors is not None:
+            rgb = np.asarray(pil, dtype=np.uint32)
+            packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+            palette = np.array(sorted((r << 16) | (g << 8) | b for _, (r, g, b) in colors), dtype=np.uint32)
+            indices = np.searchsorted(palette, packed).astype(np.uint8)
+            pil = Image.fromarray(indices, 'P')
+            pil.putpalette(np.stack([palette >> 16, (palette >> 8) & 0xFF, palette & 0xFF], axis=1)
+                           .astype(np.uint8).tobytes())
+        buffer = io.BytesIO()
+        pil.save(buffer, 'PNG', compress_level=PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
+
+
+CODECS = {codec.name: codec for codec in (JpegCodec(), WebpCodec(), WebpCodec(lossless=True), PngCodec())}
+JPEG = CODECS['jpeg']
+
+STREAM_CODECS = [name for name in os.environ.get("STREAM_CODECS", "jpeg,webp,webp-lossless,png").split(',')
+                 if name in CODECS and CODECS[name].available] or ['jpeg']
+DEFAULT_CODEC = CODECS[STREAM_CODECS[0]]
+# Codec for the tiles of STREAM_MODE=tiles ("png" keeps text pixel-exact)
+TILE_CODEC = CODECS.get(os.environ.get("TILE_CODEC", "jpeg"), JPEG)
+if not TILE_CODEC.available:
+    TILE_CODEC = JPEG
+
+
+def negotiate(requested):
+    """The codec for a client that asked for requested ("webp,jpeg"; None = default)."""
+    for name in (requested or '').split(','):
+        name = name.strip()
+        if name in STREAM_CODECS:
+            return CODECS[name]
+    return DEFAULT_CODEC
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+import metrics
+from cdp import DEVTOOLS_PORT, js_heap_usage, notify_memory_pressure
+
+# Memory governor. Chromium runs in-process (--single-process), so every
+# renderer's memory is ours and an OOM kill takes the server with it. The
+# governor samples RSS and each page's JS heap off the GUI thread; the
+# SessionManager acts on the samples in its periodic check, in steps:
+#
+#   RSS above MEMORY_PRESSURE_MB    pages get a memory-pressure notification,
+#                                   idle pages over PAGE_HEAP_LIMIT_MB are discarded
+#   RSS above SESSION_MEMORY_LIMIT  warm views, then idle pages, then idle sessions go
+#   RSS above MEMORY_RESTART_MB     the view with the biggest heap is restarted
+#                                   on the same URL and session (last resort)
+
+MB = 1024 * 1024
+MEMORY_SAMPLE_SECONDS = float(os.environ.get("MEMORY_SAMPLE_SECONDS", "5"))
+# 0 disables a step
+MEMORY_PRESSURE_MB = int(os.environ.get("MEMORY_PRESSURE_MB", "1536"))
+MEMORY_RESTART_MB = int(os.environ.get("MEMORY_RESTART_MB", "3072"))
+PAGE_HEAP_LIMIT_MB = int(os.environ.get("PAGE_HEAP_LIMIT_MB", "512"))
+# A restarted view needs time to settle before its memory says anything
+RESTART_COOLDOWN_SECONDS = 60
+
+
+def process_rss_mb():
+    # Chromium runs in-process (--single-process), so this covers every page
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / MB
+
+
+class MemoryGovernor:
+    """Samples process RSS and per-page JS heap sizes on a background thread.
+
+    Reading a heap is a DevTools round trip per page, so it never runs on
+    the GUI thread; the check reads the latest sample instead.
+    """
+
+    def __init__(self, port=DEVTOOLS_PORT, interval=MEMORY_SAMPLE_SECONDS):
+        self.port = port
+        self.interval = interval
+        self.rss_mb = process_rss_mb()
+        self._heaps = {}
+        self._pressure = threading.Event()
+        self._pressure_level = "moderate"
+        self.last_restart = 0.0
+        metrics.MEMORY_RSS_BYTES.callback = lambda: int(self.rss_mb * MB)
+        metrics.JS_HEAP_BYTES.callback = lambda: sum(self._heaps.values())
+        self._thread = threading.Thread(target=self._run, name="memory-governor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.rss_mb = process_rss_mb()
+            if self._pressure.is_set():
+                self._pressure.clear()
+                try:
+                    notify_memory_pressure(self._pressure_level, self.port)
+                    metrics.MEMORY_PRESSURE_NOTIFICATIONS.inc()
+                except Exception as e:
+                    print(f"[memory] pressure notification failed: {e}")
+            try:
+                self._heaps = js_heap_usage(self.port)
+            except Exception:
+                # DevTools isn't up yet, or is restarting with a page
+                self._heaps = {}
+            time.sleep(self.interval)
+
+    def heap_mb(self, target_id):
+        """Latest JS heap sample for the page with this DevTools id (0 if unknown)."""
+        return self._heaps.get(target_id, 0) / MB
+
+    def notify_pressure(self, level="moderate"):
+        """Asks every page to shed memory on the next sample."""
+        self._pressure_level = level
+        self._pressure.set()
+
+    def may_restart(self):
+        return time.monotonic() - self.last_restart > RESTART_COOLDOWN_SECONDS
@@ -1,6 +1,7 @@
 import sys
 import threading
 import queue
+import secrets
 from io import BytesIO
 from flask import Flask, send_file, request
 
@@ -12,18 +13,46 @@ from PyQt6.QtGui import QAction, QIcon, QMouseEvent
 
 # --- Flask Server Setup ---
 latest_screenshot_data = None
-screenshot_lock = threading.Lock()
+# Bumped only when the screen changes; ETags are built from it
+screenshot_seq = 0
+screenshot_changed = threading.Condition()
 command_queue = queue.Queue()
 
+# Keeps ETags from an earlier run from matching this one's frames
+ETAG_PREFIX = secrets.token_hex(4)
+# Longest a ?wait= long-poll is held open
+MAX_WAIT_SECONDS = 30.0
+
 flask_app = Flask(__name__)
 
+def snapshot_etag(seq):
+    return f'"{ETAG_PREFIX}-{seq}"'
+
 @flask_app.route('/snapshot')
 def snapshot():
-    with screenshot_lock:
-        if latest_screenshot_data:
-            return send_file(BytesIO(latest_screenshot_data), mimetype='image/png')
-        else:
-            return "No image yet", 404
+    """The current frame as PNG.
+
+    If-None-Match with the current ETag gets a 304. With ?wait=<seconds> as
+    well, the request is held until a newer frame exists (or the wait runs
+    out, then 304), so clients only download frames that changed.
+    """
+    known = request.headers.get('If-None-Match')
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_WAIT_SECONDS)
+    except ValueError:
+        return "Invalid wait", 400
+    with screenshot_changed:
+        if wait > 0 and known is not None:
+            screenshot_changed.wait_for(lambda: snapshot_etag(screenshot_seq) != known, wait)
+        data, etag = latest_screenshot_data, snapshot_etag(screenshot_seq)
+    if not data:
+        return "No image yet", 404
+    if known == etag:
+        return "", 304, {'ETag': etag, 'Cache-Control': 'no-cache'}
+    response = send_file(BytesIO(data), mimetype='image/png')
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @flask_app.route('/click', methods=['GET', 'POST'])
 def click():
@@ -45,7 +74,8 @@ def navigate():
         return str(e), 400
 
 def run_server():
-    flask_app.run(port=5000, host='0.0.0.0', debug=False, use_reloader=False)
+    # Threaded: long-polling clients each hold a request open
+    flask_app.run(port=5000, host='0.0.0.0', debug=False, use_reloader=False, threaded=True)
 # --------------------------
 
 class WebBrowser(QMainWindow):
@@ -112,6 +142,7 @@ class WebBrowser(QMainWindow):
         self.update_url_bar(self.browser.url())
 
         # Start Screenshot Timer
+        self.last_image = None
         self.timer = QTimer()
         self.timer.timeout.connect(self.capture_screen)
         self.timer.start(1000) # Capture every second
@@ -162,18 +193,25 @@ class WebBrowser(QMainWindow):
 
     def capture_screen(self):
         # Grab the screenshot of the browser widget
-        pixmap = self.browser.grab()
-        
+        image = self.browser.grab().toImage()
+
+        # Unchanged screen: skip the PNG encode and keep the ETag
+        if image == self.last_image:
+            return
+        self.last_image = image
+
         # Save to bytes
         buffer = QBuffer()
         buffer.open(QIODevice.OpenModeFlag.ReadWrite)
-        pixmap.save(buffer, "PNG")
+        image.save(buffer, "PNG")
         
         data = buffer.data().data()
         
-        global latest_screenshot_data
-        with screenshot_lock:
+        global latest_screenshot_data, screenshot_seq
+        with screenshot_changed:
             latest_screenshot_data = data
+            screenshot_seq += 1
+            screenshot_changed.notify_all()
 
     def navigate_home(self):
         self.browser.setUrl(QUrl("https://www.google.com"))
@@ -3,11 +3,21 @@ import tkinter as tk
 from PIL import Image, ImageTk
 from io import BytesIO
 import threading
+import queue
+import time
 import sys
 
 # URL of the browser running in the cloud VM
 DEFAULT_URL = "https://lp2z0h7b-5000.use.devtunnels.ms"
 
+# Seconds the server may hold a snapshot request until the screen changes;
+# kept short so switching servers takes effect without waiting out a poll
+LONG_POLL_SECONDS = 2
+# Fallback poll interval for servers without ETags / long-poll
+POLL_INTERVAL = 0.2
+# How often the Tk thread picks up decoded frames (ms)
+DISPLAY_INTERVAL_MS = 30
+
 class BrowserClient:
     def __init__(self, root):
         self.root = root
@@ -34,6 +44,13 @@ class BrowserClient:
         
         self.running = True
         self.target_url = DEFAULT_URL
+        # One keep-alive connection for every poll instead of a new one each time
+        self.http = requests.Session()
+        # Decoded frames and status text, handed from the fetch thread to Tk
+        self.frames = queue.Queue(maxsize=1)
+        self.statuses = queue.Queue()
+        self.last_status = None
+        threading.Thread(target=self.fetch_frames, daemon=True).start()
         self.update_image()
 
     def reset_connection(self):
@@ -45,36 +62,74 @@ class BrowserClient:
             self.url_entry.insert(0, url)
             
         self.target_url = url
-        self.status_label.config(text=f"Switched to {self.target_url}")
+        self.status(f"Switched to {self.target_url}")
+
+    def fetch_frames(self):
+        """Fetch thread: downloads and decodes a frame only when the screen has changed."""
+        etag, url = None, None
+        while self.running:
+            if url != self.target_url:
+                # New server: its ETags mean nothing to us
+                etag, url = None, self.target_url
+            started = time.monotonic()
+            try:
+                headers = {'If-None-Match': etag} if etag else {}
+                # The server holds the request until a new frame exists (long-poll)
+                response = self.http.get(url, headers=headers, params={'wait': LONG_POLL_SECONDS},
+                                         timeout=LONG_POLL_SECONDS + 5.0)
+                if url != self.target_url:
+                    # Switched servers while this poll was in flight
+                    continue
+                if response.status_code == 200:
+                    # Decode here so the Tk thread only has to show it
+                    pil_image = Image.open(BytesIO(response.content))
+                    pil_image.load()
+                    etag = response.headers.get('ETag')
+                    self.show(pil_image)
+                    self.status(f"Connected to {url} - Live")
+                elif response.status_code != 304:
+                    self.status(f"Server returned {response.status_code}")
+            except requests.exceptions.ConnectionError:
+                self.status(f"Connection lost to {url}... Retrying")
+                etag = None
+            except Exception as e:
+                print(f"Error: {e}")
+                self.status(f"Error: {str(e)}")
+                etag = None
+            # Without an ETag the server can't long-poll; don't hammer it
+            if etag is None:
+                time.sleep(max(0.0, POLL_INTERVAL - (time.monotonic() - started)))
+
+    def show(self, pil_image):
+        # Only the newest frame matters; replace one Tk hasn't shown yet
+        try:
+            self.frames.get_nowait()
+        except queue.Empty:
+            pass
+        self.frames.put(pil_image)
+
+    def status(self, text):
+        # Every poll reports; only changes need to reach the Tk thread
+        if text != self.last_status:
+            self.last_status = text
+            self.statuses.put(text)
 
     def update_image(self):
         if not self.running:
             return
-            
+
+        # Tk widgets may only be touched from this thread
         try:
-            # Use the URL from the entry box or default
-            # Timeout increased to 5 seconds to handle network latency
-            response = requests.get(self.target_url, timeout=5.0) 
-            if response.status_code == 200:
-                # Load image from content
-                image_data = BytesIO(response.content)
-                pil_image = Image.open(image_data)
-                
-                # Resize if necessary to fit window (optional, keeping original size for now)
-                self.tk_image = ImageTk.PhotoImage(pil_image)
-                
-                self.image_label.config(image=self.tk_image)
-                self.status_label.config(text=f"Connected to {self.target_url} - Live")
-            else:
-                self.status_label.config(text=f"Server returned {response.status_code}")
-        except requests.exceptions.ConnectionError:
-            self.status_label.config(text=f"Connection lost to {self.target_url}... Retrying")
-        except Exception as e:
-            print(f"Error: {e}")
-            self.status_label.config(text=f"Error: {str(e)}")
-        
-        # Schedule next update in 200ms
-        self.root.after(200, self.update_image)
+            pil_image = self.frames.get_nowait()
+            # Resize if necessary to fit window (optional, keeping original size for now)
+            self.tk_image = ImageTk.PhotoImage(pil_image)
+            self.image_label.config(image=self.tk_image)
+        except queue.Empty:
+            pass
+        while not self.statuses.empty():
+            self.status_label.config(text=self.statuses.get_nowait())
+
+        self.root.after(DISPLAY_INTERVAL_MS, self.update_image)
 
     def on_closing(self):
         self.running = False
@@ -1,19 +1,24 @@
-from flask import Flask, request, Response, render_template, redirect, url_for
+from flask import Flask, request, Response, render_template, redirect, url_for, g
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, quote_plus, unquote_plus
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, unquote_plus
+from collections import OrderedDict
 import logging
+import os
+import secrets
+import threading
+import time
+from response_cache import ResponseCache, CachedResponse, storable, fits, CACHE_MAX_ENTRY_BYTES
+from rewriter import rewrite_html_stream, rewrite_css_stream
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Global tracker for context
-CURRENT_URL = "https://www.google.com"
+# Where a new visitor's catch-all requests resolve until they open a page
+START_URL = "https://www.google.com"
 
-# Use a session to persist cookies
-SESSION = requests.Session()
 # Mimic a real browser heavily to avoid detection
-SESSION.headers.update({
+BROWSER_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
     'Accept-Language': 'en-US,en;q=0.9',
@@ -24,14 +29,138 @@ SESSION.headers.update({
     'Sec-Fetch-Site': 'none',
     'Sec-Fetch-User': '?1',
     'Cache-Control': 'max-age=0',
-})
+}
+
+# Upstream connections. Every visitor's session mounts this one adapter, so
+# keep-alive connections are pooled across visitors while cookies are not.
+# A page's subresources load in parallel up to UPSTREAM_PER_HOST per origin;
+# further requests to that origin wait for a free connection.
+UPSTREAM_HOSTS = int(os.environ.get("UPSTREAM_HOSTS", "64"))
+UPSTREAM_PER_HOST = int(os.environ.get("UPSTREAM_PER_HOST", "16"))
+UPSTREAM = HTTPAdapter(pool_connections=UPSTREAM_HOSTS, pool_maxsize=UPSTREAM_PER_HOST, pool_block=True)
+
+# Visitors are told apart by this cookie
+SESSION_COOKIE = 'proxy_session'
+MAX_USERS = int(os.environ.get("MAX_USERS", "256"))
+USER_IDLE_SECONDS = float(os.environ.get("USER_IDLE_SECONDS", "1800"))
+
+class ProxyUser:
+    """One visitor's upstream state: their cookie jar and the page relative URLs resolve against."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update(BROWSER_HEADERS)
+        self.session.mount('http://', UPSTREAM)
+        self.session.mount('https://', UPSTREAM)
+        self.current_url = START_URL
+        self.last_used = time.monotonic()
+
+class ProxyUsers:
+    """Visitors by session id, least recently used first; idle ones are forgotten."""
+
+    def __init__(self, max_users=MAX_USERS, idle_seconds=USER_IDLE_SECONDS):
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, sid):
+        """Returns (sid, user), starting a new session for unknown or expired ids."""
+        now = time.monotonic()
+        with self._lock:
+            while self._users:
+                oldest = next(iter(self._users.values()))
+                if len(self._users) < self.max_users and now - oldest.last_used < self.idle_seconds:
+                    break
+                # The adapter is shared, so the session is dropped, not closed
+                self._users.popitem(last=False)
+            user = self._users.get(sid) if sid else None
+            if user is None:
+                sid, user = secrets.token_urlsafe(16), ProxyUser()
+                self._users[sid] = user
+            else:
+                self._users.move_to_end(sid)
+            user.last_used = now
+            return sid, user
+
+    def __len__(self):
+        return len(self._users)
+
+USERS = ProxyUsers()
+
+# Responses and rewritten pages, kept per HTTP caching rules
+CACHE = ResponseCache()
+
+# Non-HTML bodies that aren't cached are relayed in chunks of this size
+STREAM_CHUNK_BYTES = 64 * 1024
+# Sent on to the origin so media players can seek
+FORWARDED_HEADERS = ['Range', 'If-Range']
+# Bodies whose URLs are pointed back through the proxy
+REWRITERS = {'text/html': rewrite_html_stream, 'text/css': rewrite_css_stream}
+
+@app.before_request
+def load_user():
+    g.user_id, g.user = USERS.get(request.cookies.get(SESSION_COOKIE))
+
+@app.after_request
+def remember_user(response):
+    if request.cookies.get(SESSION_COOKIE) != g.user_id:
+        response.set_cookie(SESSION_COOKIE, g.user_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
+# Under /_proxy so it can't shadow a proxied site's own /cache
+@app.route('/_proxy/cache')
+def cache_stats():
+    return {**CACHE.stats(), 'users': len(USERS)}
+
+def rewriter_for(content_type):
+    """The streaming rewriter for a content type, or None if it's relayed as is."""
+    for kind, rewrite in REWRITERS.items():
+        if kind in content_type:
+            return rewrite
+    return None
+
+def stream_body(resp):
+    """The upstream body as it arrives, still encoded; the connection is released at the end."""
+    try:
+        yield from resp.raw.stream(STREAM_CHUNK_BYTES, decode_content=False)
+    finally:
+        resp.close()
+
+def stream_rewritten(resp, rewrite):
+    """Rewrites the body as it arrives; once complete, it is cached with its rewritten form."""
+    keep = storable(resp)
+    body, page = [], []
+
+    def upstream():
+        nonlocal keep
+        size = 0
+        for chunk in resp.iter_content(STREAM_CHUNK_BYTES):
+            size += len(chunk)
+            if keep and size > CACHE_MAX_ENTRY_BYTES:
+                keep = False
+                body.clear()
+                page.clear()
+            if keep:
+                body.append(chunk)
+            yield chunk
+
+    try:
+        for out in rewrite(upstream(), resp.url):
+            if keep:
+                page.append(out)
+            yield out
+    finally:
+        resp.close()
+    if keep:
+        CACHE.store(resp, b''.join(body), b''.join(page))
+
 def fetch_and_render(url):
-    global CURRENT_URL
+    user = g.user
     
     # Basic URL Cleanup
     if not url.startswith('http'):
@@ -44,14 +173,17 @@ def fetch_and_render(url):
         if request.method == 'POST':
             # Send form data if POST
             # Allow redirects=False to capture 302s manually
-            resp = SESSION.post(url, data=request.form, files=request.files, allow_redirects=False)
+            resp = user.session.post(url, data=request.form, files=request.files, allow_redirects=False, stream=True)
         else:
             # Send query params if present, but exclude 'url' passed to proxy
             params = {k: v for k, v in request.args.items() if k != 'url'}
-            resp = SESSION.get(url, params=params, timeout=10, allow_redirects=False)
+            forwarded = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+            # Fresh responses come straight from the cache; stale ones are revalidated
+            resp = CACHE.get(user.session, url, params=params, timeout=10, headers=forwarded)
         
         # Handle Redirects Manually
         if resp.is_redirect:
+            resp.close()
             location = resp.headers.get('Location')
             if location:
                 new_dest = urljoin(url, location)
@@ -60,67 +192,43 @@ def fetch_and_render(url):
                 return redirect(url_for('proxy', url=new_dest))
         
         # Update Context on successful fetch (non-redirect, or final)
-        CURRENT_URL = resp.url
+        user.current_url = resp.url
 
     except Exception as e:
         return f"Error fetching {url}: {str(e)}", 500
 
+    content_type = resp.headers.get('Content-Type', '').lower()
+    rewrite = rewriter_for(content_type)
+    cached = isinstance(resp, CachedResponse)
+
+    if rewrite is None and not cached and not (storable(resp) and fits(resp)):
+        # Relay the body untouched (still compressed, with its length and any
+        # Content-Range) without ever holding all of it
+        excluded_headers = ['transfer-encoding', 'connection', 'keep-alive', 'content-security-policy']
+        headers = [(name, value) for (name, value) in resp.headers.items()
+                   if name.lower() not in excluded_headers]
+        return Response(stream_body(resp), resp.status_code, headers, direct_passthrough=True)
+
     # Pass headers
     excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection', 'content-security-policy']
     headers = [(name, value) for (name, value) in resp.headers.items() 
                if name.lower() not in excluded_headers]
 
-    content_type = resp.headers.get('Content-Type', '').lower()
+    if cached:
+        if rewrite is None:
+            return Response(resp.content, resp.status_code, headers)
+        # An unchanged cached page is rewritten once, not on every view
+        page = CACHE.rendered(resp, lambda: b''.join(rewrite([resp.content], resp.url)))
+        return Response(page, resp.status_code, headers)
 
-    if 'text/html' in content_type:
-        soup = BeautifulSoup(resp.content, 'html.parser')
-        
-        # Rewrite common attributes
-        tags_attributes = {
-            'a': 'href',
-            'link': 'href',
-            'script': 'src',
-            'img': 'src',
-            'iframe': 'src',
-            'form': 'action',
-            'source': 'src',
-            'video': 'src',
-            'audio': 'src',
-            'object': 'data',
-            'embed': 'src'
-        }
-
-        for tag_name, attr in tags_attributes.items():
-            for tag in soup.find_all(tag_name):
-                if tag.has_attr(attr):
-                    original = tag[attr]
-                    # Skip internal links, javascript calls, data URIs
-                    if not original or original.startswith('data:') or original.startswith('#') or original.startswith('javascript:'):
-                        continue
-                        
-                    # Resolve relative to absolute
-                    absolute_url = urljoin(resp.url, original)
-                    
-                    # Rewrite to point to proxy
-                    new_val = f"/proxy?url={quote_plus(absolute_url)}"
-                    tag[attr] = new_val
-        
-        # Rewrite Meta Refresh
-        for meta in soup.find_all('meta', attrs={'http-equiv': lambda x: x and x.lower() == 'refresh'}):
-            if meta.has_attr('content'):
-                content = meta['content']
-                parts = content.split('url=', 1)
-                if len(parts) > 1:
-                    delay = parts[0]
-                    target_url = parts[1].strip("'\" ")
-                    absolute_target = urljoin(resp.url, target_url)
-                    new_val = f"{delay}url=/proxy?url={quote_plus(absolute_target)}"
-                    meta['content'] = new_val
-
-        return Response(str(soup), resp.status_code, headers)
-
-    # For everything else (images, css, js)
-    return Response(resp.content, resp.status_code, headers)
+    if rewrite is None:
+        # Small enough to cache: read it whole
+        body = resp.content
+        CACHE.store(resp, body)
+        return Response(body, resp.status_code, headers)
+
+    # Pages start reaching the client before the origin has sent all of them
+    return Response(stream_rewritten(resp, rewrite), resp.status_code, headers)
 
 @app.route('/proxy', methods=['GET', 'POST'])
 def proxy():
@@ -128,26 +236,25 @@ def proxy():
     if not url:
         # If no URL provided, try to stay on current context or show error, 
         # but DO NOT go back to index.html
-        if CURRENT_URL:
-             return fetch_and_render(CURRENT_URL)
+        if g.user.current_url:
+             return fetch_and_render(g.user.current_url)
         return "Error: No URL provided and no history available.", 400
     return fetch_and_render(url)
 
 @app.route('/<path:path>', methods=['GET', 'POST'])
 def catch_all(path):
-    global CURRENT_URL
     # We are here because a relative path was requested (e.g. /search?q=foo)
-    # We reconstruct the full intended URL using the last known CURRENT_URL
+    # We reconstruct the full intended URL using this visitor's last page
     # request.full_path includes the query string e.g., "/search?q=hello"
     
     # If path matches a known route like proxy, skip (Flask handles it, but just in case)
     if path == 'proxy':
         return proxy()
         
-    target_url = urljoin(CURRENT_URL, request.full_path)
+    target_url = urljoin(g.user.current_url, request.full_path)
     logging.info(f"Catch-all caught '{path}'. Proxying to: {target_url}")
     return fetch_and_render(target_url)
 
 if __name__ == '__main__':
     # Run on default port 5000
-    app.run(host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
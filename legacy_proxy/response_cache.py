@@ -0,0 +1,347 @@
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# HTTP cache for the proxy: fresh responses are served without going to the
+# origin, stale ones are revalidated with If-None-Match / If-Modified-Since,
+# and the rewritten HTML of a page is kept beside it so a repeat view of an
+# unchanged page skips parsing too.
+#
+# Entries live in a byte-bounded in-memory LRU; every stored entry is also
+# written to CACHE_DIR, so memory evictions and restarts fall back to disk
+# instead of the network.
+
+CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+CACHE_MEMORY_MB = int(os.environ.get("CACHE_MEMORY_MB", "64"))
+CACHE_DISK_MB = int(os.environ.get("CACHE_DISK_MB", "512"))
+# Bigger bodies are never cached (video, large downloads)
+CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+# Without explicit freshness a response stays fresh for this share of its
+# age since Last-Modified, capped (RFC 9111 heuristic freshness)
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_SECONDS = 24 * 3600
+
+CACHEABLE_STATUS = {200, 203, 404, 410}
+# Headers that describe one transfer, not the stored response
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length',
+               'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'upgrade'}
+# Request headers that carry a visitor's identity
+VISITOR_HEADERS = {'cookie', 'authorization'}
+MB = 1024 * 1024
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+
+def parse_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers, now):
+    """Seconds a response stays fresh from when it was received (0 = revalidate every time)."""
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in cc:
+        return 0
+    try:
+        age = float(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    # A shared cache takes s-maxage over max-age
+    max_age = cc.get('s-maxage', cc.get('max-age'))
+    if max_age is not None:
+        try:
+            return max(0, int(max_age) - age)
+        except ValueError:
+            return 0
+    date = parse_date(headers.get('Date')) or now
+    expires = headers.get('Expires')
+    if expires is not None:
+        # Invalid dates (e.g. "0") mean already expired
+        expires_at = parse_date(expires)
+        return max(0, expires_at - date - age) if expires_at else 0
+    last_modified = parse_date(headers.get('Last-Modified'))
+    if last_modified is not None:
+        return min(HEURISTIC_MAX_SECONDS, max(0, (date - last_modified) * HEURISTIC_FRACTION))
+    return 0
+
+
+def storable(resp):
+    """Whether resp may be cached, judged on its headers alone (the body may still be unread).
+
+    The cache is shared by every visitor and keyed by URL alone, so
+    anything that may differ per visitor is refused: responses marked
+    private or setting cookies, responses that vary on the visitor's
+    credentials, and responses to requests that carried credentials unless
+    the origin says they may be shared (public or s-maxage).
+
+    Responses that are stale on arrival and carry no validator are refused
+    too: they could never be served again or revalidated, so storing them
+    would only push useful entries out.
+    """
+    cc = parse_cache_control(resp.headers.get('Cache-Control'))
+    if (resp.status_code not in CACHEABLE_STATUS or 'no-store' in cc
+            or 'private' in cc or 'Set-Cookie' in resp.headers):
+        return False
+    vary = {name.strip().lower() for name in resp.headers.get('Vary', '').split(',')}
+    if vary & VISITOR_HEADERS or '*' in vary:
+        return False
+    if ('ETag' not in resp.headers and 'Last-Modified' not in resp.headers
+            and freshness_lifetime(resp.headers, time.time()) == 0):
+        return False
+    request_headers = resp.request.headers
+    if any(name in request_headers for name in VISITOR_HEADERS):
+        return 'public' in cc or 's-maxage' in cc
+    return True
+
+
+def fits(resp):
+    """Whether resp's body is known to be small enough to cache."""
+    length = resp.headers.get('Content-Length', '')
+    return length.isdigit() and int(length) <= CACHE_MAX_ENTRY_BYTES
+
+
+class CacheEntry:
+    def __init__(self, key, url, status, headers, body, stored_at, expires_at, rendered=None):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        # (validator, rewritten page bytes) once the page has been rendered
+        self.rendered = rendered
+
+    @property
+    def validator(self):
+        return self.headers.get('ETag') or self.headers.get('Last-Modified')
+
+    @property
+    def size(self):
+        return len(self.body) + (len(self.rendered[1]) if self.rendered else 0)
+
+    def fresh(self, now):
+        return now < self.expires_at
+
+    def conditional_headers(self):
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+
+class CachedResponse:
+    """The parts of a requests.Response that fetch_and_render uses, served from an entry."""
+
+    is_redirect = False
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.url = entry.url
+        self.status_code = entry.status
+        self.headers = entry.headers
+        self.content = entry.body
+
+
+class DiskTier:
+    """Entries as <sha256>.json (metadata) + .body (+ .html for the rewritten page)."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ext)
+
+    def load(self, key):
+        try:
+            with open(self._path(key, '.json')) as f:
+                meta = json.load(f)
+            with open(self._path(key, '.body'), 'rb') as f:
+                body = f.read()
+            rendered = None
+            if meta['rendered']:
+                with open(self._path(key, '.html'), 'rb') as f:
+                    rendered = (meta['rendered_validator'], f.read())
+        except (OSError, ValueError):
+            return None
+        # Touch for the oldest-first eviction
+        os.utime(self._path(key, '.json'))
+        return CacheEntry(key, meta['url'], meta['status'], meta['headers'], body,
+                          meta['stored_at'], meta['expires_at'], rendered)
+
+    def store(self, key, entry):
+        meta = {'url': entry.url, 'status': entry.status, 'headers': dict(entry.headers),
+                'stored_at': entry.stored_at, 'expires_at': entry.expires_at,
+                'rendered': entry.rendered is not None,
+                'rendered_validator': entry.rendered[0] if entry.rendered else None}
+        files = [('.body', entry.body)]
+        if entry.rendered:
+            files.append(('.html', entry.rendered[1]))
+        # Metadata last: an entry without it is never loaded
+        files.append(('.json', json.dumps(meta).encode()))
+        with self._lock:
+            self._remove(key)
+            for ext, data in files:
+                tmp = self._path(key, ext) + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key, ext))
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _remove(self, key):
+        for ext in ('.json', '.body', '.html'):
+            path = self._path(key, ext)
+            try:
+                self._size -= os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Drops least recently used entries until the tier is 90% full."""
+        metas = sorted((os.path.getmtime(os.path.join(self.directory, name)), name)
+                       for name in os.listdir(self.directory) if name.endswith('.json'))
+        for _, name in metas:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            stem = os.path.join(self.directory, name[:-len('.json')])
+            for ext in ('.json', '.body', '.html'):
+                try:
+                    self._size -= os.path.getsize(stem + ext)
+                    os.remove(stem + ext)
+                except OSError:
+                    pass
+
+
+class ResponseCache:
+    """Byte-bounded memory LRU over an optional disk tier. Thread-safe."""
+
+    def __init__(self, memory_bytes=CACHE_MEMORY_MB * MB, directory=CACHE_DIR, disk_bytes=CACHE_DISK_MB * MB):
+        self.memory_bytes = memory_bytes
+        self.disk = DiskTier(directory, disk_bytes) if directory and disk_bytes else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = self.revalidated = self.misses = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self.disk.load(key) if self.disk else None
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.memory_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+
+    def _store(self, key, entry):
+        self._remember(key, entry)
+        if self.disk:
+            try:
+                self.disk.store(key, entry)
+            except OSError as e:
+                logging.warning(f"Cache write failed for {entry.url}: {e}")
+
+    def get(self, session, url, params=None, timeout=10, headers=None):
+        """GET url through the cache. Returns a CachedResponse or the origin's requests.Response.
+
+        Origin responses come back unread (stream=True) so large bodies can
+        be passed on chunk by chunk; hand the body to store() to cache it.
+        Requests with extra headers (Range) bypass the cache.
+        """
+        key = session.prepare_request(requests.Request('GET', url, params=params or None)).url
+        if headers:
+            return session.get(key, headers=headers, timeout=timeout, allow_redirects=False, stream=True)
+        now = time.time()
+        entry = self._lookup(key)
+        if entry is not None and entry.fresh(now):
+            self.hits += 1
+            return CachedResponse(entry)
+
+        headers = entry.conditional_headers() if entry is not None else {}
+        resp = session.get(key, headers=headers, timeout=timeout, allow_redirects=False, stream=True)
+        now = time.time()
+        if entry is not None and resp.status_code == 304:
+            resp.close()
+            # Unchanged: keep the body (and its rewritten page), take the new headers
+            self.revalidated += 1
+            entry.headers.update({k: v for k, v in resp.headers.items() if k.lower() not in HOP_HEADERS})
+            entry.stored_at = now
+            entry.expires_at = now + freshness_lifetime(entry.headers, now)
+            if entry.rendered and entry.rendered[0] != entry.validator:
+                entry.rendered = None
+            self._store(key, entry)
+            return CachedResponse(entry)
+
+        self.misses += 1
+        return resp
+
+    def store(self, resp, body, rendered=None):
+        """Caches an origin response from get() once its body has been read.
+
+        rendered is the rewritten page, if there is one. Responses that
+        aren't storable() or are too big are ignored.
+        """
+        if not storable(resp) or len(body) > CACHE_MAX_ENTRY_BYTES or resp.request.method != 'GET':
+            return
+        now = time.time()
+        headers = [(k, v) for k, v in resp.headers.items() if k.lower() not in HOP_HEADERS]
+        entry = CacheEntry(resp.request.url, resp.url, resp.status_code, headers, body,
+                           now, now + freshness_lifetime(resp.headers, now))
+        if rendered is not None:
+            entry.rendered = (entry.validator, rendered)
+        self._store(entry.key, entry)
+
+    def rendered(self, resp, render):
+        """The rewritten page for resp, from render() only when the stored one is out of date."""
+        entry = getattr(resp, 'entry', None)
+        if entry is None:
+            return render()
+        if entry.rendered is not None and entry.rendered[0] == entry.validator:
+            return entry.rendered[1]
+        page = render()
+        entry.rendered = (entry.validator, page)
+        self._store(entry.key, entry)
+        return page
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'memory_bytes': self._size,
+                    'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses}
@@ -0,0 +1,249 @@
+import html
+import re
+from urllib.parse import urljoin, quote_plus
+
+# Single-pass streaming rewriter for proxied pages and stylesheets. Every
+# URL a page can load from (links, resources, srcset, style attributes,
+# <style> blocks, CSS url()/@import and meta refresh) is pointed back
+# through /proxy.
+#
+# It works on bytes: anything that isn't a URL is passed through exactly as
+# the origin sent it, whatever the page's charset, and output is produced
+# chunk by chunk as the upstream body arrives.
+
+# Attributes holding one URL, per tag
+URL_ATTRIBUTES = {
+    b'a': b'href',
+    b'link': b'href',
+    b'script': b'src',
+    b'img': b'src',
+    b'iframe': b'src',
+    b'form': b'action',
+    b'source': b'src',
+    b'video': b'src',
+    b'audio': b'src',
+    b'object': b'data',
+    b'embed': b'src',
+}
+SRCSET_TAGS = {b'img', b'source'}
+SKIPPED_PREFIXES = (b'data:', b'#', b'javascript:', b'mailto:', b'blob:')
+
+# A start or end tag; quoted attribute values may contain '>'
+TAG = re.compile(rb'<(/?)([a-zA-Z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+TAG_START = re.compile(rb'</?[a-zA-Z!?]')
+ATTRIBUTE = re.compile(rb'([^\s=/>]+)(\s*=\s*)("[^"]*"|\'[^\']*\'|[^\s>]+)?')
+CSS_URL = re.compile(rb'(url\(\s*)(["\']?)([^"\')]*)(\2\s*\))', re.IGNORECASE)
+CSS_IMPORT = re.compile(rb'(@import\s+)(["\'])([^"\']*)(\2)', re.IGNORECASE)
+SRCSET_CANDIDATE = re.compile(rb'(\s*)([^\s,]+)([^,]*)')
+REFRESH_URL = re.compile(rb'(url\s*=\s*)(["\']?)(.*?)\2\s*$', re.IGNORECASE | re.DOTALL)
+
+# Elements whose content is not markup
+RAW_TEXT = {name: re.compile(rb'</' + name + rb'\s*>', re.IGNORECASE)
+            for name in (b'script', b'style', b'textarea', b'title', b'xmp')}
+# A tag that hasn't closed after this much input is treated as text
+MAX_TAG_BYTES = 64 * 1024
+
+
+def unescape(value):
+    """value (bytes) with its HTML entities decoded."""
+    return html.unescape(value.decode('utf-8', 'surrogateescape')).encode('utf-8', 'surrogateescape')
+
+
+def escape(value):
+    """value (bytes) made safe to put back in a quoted attribute."""
+    return value.replace(b'&', b'&amp;').replace(b'"', b'&quot;').replace(b"'", b'&#39;')
+
+
+def proxied(url, base, entities=True):
+    """The /proxy URL for url (bytes) relative to base (bytes).
+
+    entities says whether url may still hold HTML entities (it came
+    straight from an attribute) or is plain text (CSS, decoded values).
+    """
+    url = url.strip()
+    if not url or url.lower().startswith(SKIPPED_PREFIXES):
+        return None
+    if entities and b'&' in url:
+        url = unescape(url)
+    return b'/proxy?url=' + quote_plus(urljoin(base, url)).encode()
+
+
+def rewrite_css(css, base):
+    """CSS text (a stylesheet, <style> block or decoded style attribute) with url() and @import proxied."""
+    def replace(match):
+        target = proxied(match.group(3), base, entities=False)
+        if target is None:
+            return match.group(0)
+        return match.group(1) + match.group(2) + target + match.group(4)
+    if b'url(' in css.lower():
+        css = CSS_URL.sub(replace, css)
+    if b'@import' in css.lower():
+        css = CSS_IMPORT.sub(replace, css)
+    return css
+
+
+def rewrite_srcset(srcset, base):
+    """A decoded srcset value with each candidate URL proxied."""
+    def replace(match):
+        target = proxied(match.group(2), base, entities=False)
+        return match.group(0) if target is None else match.group(1) + target + match.group(3)
+    return SRCSET_CANDIDATE.sub(replace, srcset)
+
+
+def rewrite_decoded(value, rewrite, base):
+    """Runs rewrite on an attribute value's text, entities decoded, and escapes the result again."""
+    if b'&' not in value:
+        return rewrite(value, base)
+    text = unescape(value)
+    new = rewrite(text, base)
+    return value if new == text else escape(new)
+
+
+def rewrite_refresh(content, base):
+    match = REFRESH_URL.search(content)
+    if match is None:
+        return content
+    target = proxied(match.group(3), base)
+    return content if target is None else content[:match.start()] + match.group(1) + target
+
+
+class HtmlRewriter:
+    """Incremental rewriter: feed() body chunks, then close(); each returns the output ready so far.
+
+    Text and unchanged tags are copied through as slices; only the tags
+    that carry URLs are rebuilt.
+    """
+
+    def __init__(self, base_url):
+        self.base = base_url.encode() if isinstance(base_url, str) else base_url
+        self._buffer = b''
+        # Name of the raw-text element we are inside (script, style...), or None
+        self._raw = None
+
+    def feed(self, data):
+        self._buffer += data
+        return self._process(final=False)
+
+    def close(self):
+        return self._process(final=True)
+
+    def _process(self, final):
+        buf, out, pos = self._buffer, [], 0
+        while pos < len(buf):
+            if self._raw is not None:
+                end = RAW_TEXT[self._raw].search(buf, pos)
+                if end is None:
+                    if final:
+                        out.append(self._raw_text(buf[pos:]))
+                        pos = len(buf)
+                    elif self._raw != b'style':
+                        # Keep enough back to spot an end tag split across chunks
+                        keep = max(pos, len(buf) - len(self._raw) - 16)
+                        out.append(buf[pos:keep])
+                        pos = keep
+                    break
+                out.append(self._raw_text(buf[pos:end.start()]))
+                out.append(end.group(0))
+                pos = end.end()
+                self._raw = None
+                continue
+
+            lt = buf.find(b'<', pos)
+            if lt == -1:
+                out.append(buf[pos:])
+                pos = len(buf)
+                break
+            out.append(buf[pos:lt])
+            pos = lt
+            if buf.startswith(b'<!--', lt):
+                end = buf.find(b'-->', lt + 4)
+                if end == -1:
+                    if not final:
+                        break
+                    end = len(buf) - 3
+                out.append(buf[lt:end + 3])
+                pos = end + 3
+                continue
+            if buf.startswith((b'<!', b'<?'), lt):
+                end = buf.find(b'>', lt)
+                if end == -1 and not final:
+                    break
+                end = len(buf) - 1 if end == -1 else end
+                out.append(buf[lt:end + 1])
+                pos = end + 1
+                continue
+            match = TAG.match(buf, lt)
+            if match is None:
+                if not final and (len(buf) - lt < 2 or TAG_START.match(buf, lt)) and len(buf) - lt < MAX_TAG_BYTES:
+                    break  # The rest of the tag is still on its way
+                out.append(b'<')
+                pos = lt + 1
+                continue
+            out.append(self._tag(match))
+            pos = match.end()
+            name = match.group(2).lower()
+            if not match.group(1) and name in RAW_TEXT:
+                self._raw = name
+        self._buffer = buf[pos:]
+        return b''.join(out)
+
+    def _raw_text(self, text):
+        return rewrite_css(text, self.base) if self._raw == b'style' else text
+
+    def _tag(self, match):
+        closing, name, attributes = match.group(1), match.group(2).lower(), match.group(3)
+        if closing or not attributes.strip():
+            return match.group(0)
+        url_attribute = URL_ATTRIBUTES.get(name)
+        lowered = attributes.lower()
+        if (url_attribute is None and b'style' not in lowered and name not in (b'meta', b'base')):
+            return match.group(0)
+
+        def replace(attribute):
+            key, equals, value = attribute.group(1).lower(), attribute.group(2), attribute.group(3)
+            if value is None:
+                return attribute.group(0)
+            quote = value[:1] if value[:1] in (b'"', b"'") else b''
+            raw = value[1:-1] if quote else value
+            if key == url_attribute:
+                new = proxied(raw, self.base)
+            elif key == b'srcset' and name in SRCSET_TAGS:
+                new = rewrite_decoded(raw, rewrite_srcset, self.base)
+            elif key == b'style':
+                new = rewrite_decoded(raw, rewrite_css, self.base)
+            elif key == b'content' and name == b'meta' and b'refresh' in lowered:
+                new = rewrite_refresh(raw, self.base)
+            elif key == b'href' and name == b'base':
+                # Links are already absolute; a live <base> would send them to the origin
+                self.base = urljoin(self.base, unescape(raw))
+                return b'data-proxy-base' + equals + value
+            else:
+                return attribute.group(0)
+            if new is None or new == raw:
+                return attribute.group(0)
+            quote = quote or b'"'
+            return attribute.group(1) + equals + quote + new + quote
+
+        return b'<' + match.group(2) + ATTRIBUTE.sub(replace, attributes) + b'>'
+
+
+def rewrite_html_stream(chunks, base_url):
+    """Yields the rewritten page as chunks (bytes) arrive."""
+    rewriter = HtmlRewriter(base_url)
+    for chunk in chunks:
+        out = rewriter.feed(chunk)
+        if out:
+            yield out
+    out = rewriter.close()
+    if out:
+        yield out
+
+
+def rewrite_css_stream(chunks, base_url):
+    """Yields the rewritten stylesheet. A url() can span chunks, so it comes out in one piece."""
+    base = base_url.encode() if isinstance(base_url, str) else base_url
+    yield rewrite_css(b''.join(chunks), base)
+
+
+def rewrite_html(content, base_url):
+    return b''.join(rewrite_html_stream([content], base_url))
@@ -0,0 +1,141 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text-format metrics for the capture, stream and input pipeline.
+# Recording is a lock and a bisect, so it stays on in production; everything
+# is process-wide (summed over sessions) to keep /metrics small. Under
+# router.py every worker is its own process; the router's /metrics serves
+# them all, labelled worker="<index>".
+
+PREFIX = "browser_"
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BYTES_BUCKETS = (1024, 4096, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+_registry = []
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = PREFIX + name
+        self.help = help
+        self._lock = threading.Lock()
+        self._value = 0
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter",
+                f"{self.name} {self._value}"]
+
+
+class Gauge:
+    """A value read at scrape time from callback()."""
+
+    def __init__(self, name, help, callback=None):
+        self.name = PREFIX + name
+        self.help = help
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self):
+        value = self.callback() if self.callback else 0
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=SECONDS_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # One slot per bucket plus +Inf; made cumulative when rendered
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        _registry.append(self)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Pipeline Metrics ---
+GRAB_SECONDS = Histogram("grab_seconds", "Time to grab the view into a QImage (GUI thread).")
+ENCODE_SECONDS = Histogram("encode_seconds", "Time to encode a full frame in the default codec.")
+VARIANT_ENCODE_SECONDS = Histogram("variant_encode_seconds",
+                                   "Time to encode a frame variant (other codec, quality or size) for clients.")
+TILES_SECONDS = Histogram("tiles_update_seconds", "Time to diff and encode a frame's changed tiles.")
+FRAME_BYTES = Histogram("frame_bytes", "Size of each published frame in the default codec.", BYTES_BUCKETS)
+SEND_SECONDS = Histogram("stream_send_seconds", "Time to write one frame or tile message to one client.")
+SENT_BYTES = Counter("stream_sent_bytes_total", "Bytes written to stream clients.")
+
+FRAMES_PUBLISHED = Counter("frames_published_total", "Frames published to stream clients.")
+FRAMES_DROPPED = Counter("frames_dropped_total",
+                         "Captures dropped because every encoder was busy or a later frame was already out.")
+FRAMES_DUPLICATE = Counter("frames_duplicate_total", "Captured frames identical to the previous one.")
+
+INPUT_QUEUE_DEPTH = Gauge("input_queue_depth", "Commands waiting for the GUI thread.")
+INPUT_QUEUE_AGE = Gauge("input_queue_age_seconds", "How long the oldest waiting command has waited.")
+INPUT_QUEUE_DELAY = Histogram("input_queue_delay_seconds",
+                              "Time from a command arriving to the GUI thread draining it.")
+INPUT_TO_FRAME = Histogram("input_to_frame_seconds",
+                           "Time from input arriving to the first frame published after it was applied.")
+
+REQUESTS_SEEN = Counter("requests_total", "Subresource requests seen by the request filter.")
+REQUESTS_BLOCKED_LIST = Counter("requests_blocked_list_total", "Requests blocked by a blocklist.")
+REQUESTS_BLOCKED_MEDIA = Counter("requests_blocked_media_total", "Audio and video requests blocked.")
+REQUESTS_BLOCKED_FONT = Counter("requests_blocked_font_total", "Web font requests blocked.")
+REQUESTS_BLOCKED_FRAME = Counter("requests_blocked_frame_total", "Third-party frame requests blocked.")
+
+MEMORY_RSS_BYTES = Gauge("memory_rss_bytes", "Resident size of the process, renderers included.")
+JS_HEAP_BYTES = Gauge("js_heap_bytes", "JS heap in use, summed over the pages DevTools could sample.")
+MEMORY_PRESSURE_NOTIFICATIONS = Counter("memory_pressure_notifications_total",
+                                        "Times pages were sent a memory-pressure notification.")
+PAGES_DISCARDED = Counter("pages_discarded_total", "Idle pages discarded to free memory.")
+VIEWS_RESTARTED = Counter("views_restarted_total", "Views recreated on their URL to free memory.")
+
+
+def record_send(nbytes, seconds):
+    SEND_SECONDS.observe(seconds)
+    SENT_BYTES.inc(nbytes)
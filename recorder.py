@@ -0,0 +1,268 @@
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Session recordings: every changed frame and every input command, appended
+# to segment files with a timestamp index beside each one. Identical frames
+# never reach the recorder (FrameBroadcaster drops them), so a recording
+# grows with how much the screen changes, not with how long it runs.
+#
+# <dir>/<n>.rec    records: RECORD_HEADER, then the payload
+# <dir>/<n>.fidx   FRAME_INDEX entries (timestamp, offset) for the frame records
+# <dir>/<n>.iidx   the same for the input records
+#
+# Every frame is a complete image, so replay can start at any of them.
+
+RECORD_FRAME = 1
+RECORD_INPUT = 2
+# kind, wall-clock timestamp, payload length
+RECORD_HEADER = struct.Struct('<BdI')
+INDEX_ENTRY = struct.Struct('<dQ')
+# Frame payload: u8 codec name length, codec name, image bytes
+CODEC_NAME = struct.Struct('<B')
+
+# Directory recordings go in, one subdirectory per session (unset: don't record).
+# router.py points each worker at a worker-<n> subdirectory of its own.
+RECORD_DIR = os.environ.get("RECORD_DIR")
+# A new segment starts once the current one reaches this size
+SEGMENT_BYTES = 64 * 1024 * 1024
+# Replay shortens pauses longer than this (idle pages publish nothing)
+REPLAY_MAX_WAIT = 2.0
+
+
+class SessionRecorder:
+    """Appends a session's frames and input to a recording directory.
+
+    Safe to call from any thread. An index entry is only written after its
+    record is on disk, so readers never see a half-written record.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        existing = [int(os.path.basename(p).split('.')[0]) for p in glob.glob(os.path.join(directory, '*.rec'))]
+        # Never append to a segment from an earlier run; its tail may be torn
+        self._segment = max(existing, default=0)
+        self._files = None
+        self._size = 0
+        self._last_seq = 0
+        self._closed = False
+        self.frames = 0
+        self.inputs = 0
+
+    def _open_segment(self):
+        self._close_files()
+        self._segment += 1
+        base = os.path.join(self.directory, f'{self._segment:06d}')
+        self._files = {kind: open(f'{base}.{ext}', 'ab') for kind, ext in
+                       (('rec', 'rec'), (RECORD_FRAME, 'fidx'), (RECORD_INPUT, 'iidx'))}
+        self._size = 0
+
+    def _close_files(self):
+        if self._files:
+            for f in self._files.values():
+                f.close()
+        self._files = None
+
+    def _append(self, kind, payload, timestamp):
+        with self._lock:
+            if self._closed:
+                return
+            if self._files is None or self._size >= self.segment_bytes:
+                self._open_segment()
+            offset = self._size
+            rec = self._files['rec']
+            rec.write(RECORD_HEADER.pack(kind, timestamp, len(payload)))
+            rec.write(payload)
+            rec.flush()
+            self._size += RECORD_HEADER.size + len(payload)
+            index = self._files[kind]
+            index.write(INDEX_ENTRY.pack(timestamp, offset))
+            index.flush()
+
+    def record_frame(self, seq, frame, codec_name):
+        """Appends frame unless seq was already recorded (listeners can race)."""
+        with self._lock:
+            if seq <= self._last_seq:
+                return
+            self._last_seq = seq
+        name = codec_name.encode()
+        self._append(RECORD_FRAME, CODEC_NAME.pack(len(name)) + name + frame.data, time.time())
+        self.frames += 1
+
+    def record_input(self, commands):
+        self._append(RECORD_INPUT, json.dumps(commands).encode(), time.time())
+        self.inputs += 1
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._close_files()
+
+
+class _Segment:
+    """One segment mapped read-only, as it was when opened."""
+
+    def __init__(self, base):
+        self.rec = self._map(base + '.rec')
+        self.frames = self._map(base + '.fidx')
+        self.inputs = self._map(base + '.iidx')
+
+    def _map(self, path):
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # Empty files can't be mapped; a segment mid-write is read up to now
+                return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def count(index):
+        return len(index) // INDEX_ENTRY.size if index is not None else 0
+
+    @staticmethod
+    def entry(index, i):
+        return INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+
+    def first_time(self):
+        times = [self.entry(index, 0)[0] for index in (self.frames, self.inputs) if self.count(index)]
+        return min(times) if times else None
+
+    def payload(self, offset):
+        kind, timestamp, length = RECORD_HEADER.unpack_from(self.rec, offset)
+        start = offset + RECORD_HEADER.size
+        return kind, timestamp, self.rec[start:start + length]
+
+    def bisect(self, index, timestamp, left=False):
+        """Number of entries before timestamp (left) or at or before it, by binary search."""
+        lo, hi = 0, self.count(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self.entry(index, mid)[0]
+            if t < timestamp or (not left and t == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        for m in (self.rec, self.frames, self.inputs):
+            if m is not None:
+                m.close()
+
+
+class RecordingReader:
+    """Seekable, memory-mapped access to a recording directory.
+
+    Seeking is a binary search over segment start times and then over the
+    segment's frame index; nothing before the target is read or decoded.
+    """
+
+    def __init__(self, directory):
+        paths = sorted(glob.glob(os.path.join(directory, '*.rec')))
+        if not paths:
+            raise FileNotFoundError(directory)
+        segments = [_Segment(path[:-len('.rec')]) for path in paths]
+        self._segments = [s for s in segments if s.rec is not None and s.first_time() is not None]
+        self._starts = [s.first_time() for s in self._segments]
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self):
+        frames = sum(_Segment.count(s.frames) for s in self._segments)
+        inputs = sum(_Segment.count(s.inputs) for s in self._segments)
+        end = None
+        for segment in self._segments:
+            for index in (segment.frames, segment.inputs):
+                n = _Segment.count(index)
+                if n:
+                    end = max(end or 0, _Segment.entry(index, n - 1)[0])
+        return {'start': self._starts[0] if self._starts else None, 'end': end,
+                'frames': frames, 'inputs': inputs, 'segments': len(self._segments),
+                'bytes': sum(len(s.rec) for s in self._segments)}
+
+    @staticmethod
+    def _frame(segment, i):
+        _, offset = _Segment.entry(segment.frames, i)
+        _, timestamp, payload = segment.payload(offset)
+        name_length = payload[0]
+        return timestamp, payload[1:1 + name_length].decode(), payload[1 + name_length:]
+
+    def frames_from(self, timestamp):
+        """Yields (timestamp, codec name, image bytes) from the frame on screen at timestamp on.
+
+        Before the first frame nothing was on screen; the first frame comes first.
+        """
+        s = max(0, bisect.bisect_right(self._starts, timestamp) - 1)
+        if s >= len(self._segments):
+            return
+        i = self._segments[s].bisect(self._segments[s].frames, timestamp) - 1
+        if i < 0 and s > 0:
+            # The frame on screen was the last one of an earlier segment
+            for back in range(s - 1, -1, -1):
+                n = _Segment.count(self._segments[back].frames)
+                if n:
+                    s, i = back, n - 1
+                    break
+        i = max(i, 0)
+        for segment in self._segments[s:]:
+            for j in range(i, _Segment.count(segment.frames)):
+                yield self._frame(segment, j)
+            i = 0
+
+    def frame_at(self, timestamp):
+        """(timestamp, codec name, image bytes) of the frame on screen at timestamp, or None."""
+        found = next(self.frames_from(timestamp), None)
+        # Nothing was on screen before the first frame
+        return found if found is not None and found[0] <= timestamp else None
+
+    def inputs_between(self, start, end):
+        """[(timestamp, commands)] recorded in [start, end]."""
+        found = []
+        s = max(0, bisect.bisect_right(self._starts, start) - 1)
+        for segment in self._segments[s:]:
+            if segment.first_time() > end:
+                break
+            for i in range(segment.bisect(segment.inputs, start, left=True), _Segment.count(segment.inputs)):
+                timestamp, offset = _Segment.entry(segment.inputs, i)
+                if timestamp > end:
+                    break
+                found.append((timestamp, json.loads(segment.payload(offset)[2])))
+        return found
+
+
+def open_recording(sid):
+    """A RecordingReader for session sid; FileNotFoundError if there is none."""
+    # sid comes from the URL; never let it leave RECORD_DIR
+    if not RECORD_DIR or sid in ('', '.', '..') or os.path.basename(sid) != sid:
+        raise FileNotFoundError(sid)
+    return RecordingReader(os.path.join(RECORD_DIR, sid))
+
+
+def replay(reader, start, speed=1.0):
+    """Yields (wait, codec name, image bytes): wait seconds, then show the image.
+
+    Starts with the frame on screen at start and keeps the recorded pacing,
+    sped up by speed.
+    """
+    previous = None
+    for timestamp, codec_name, data in reader.frames_from(start):
+        wait = 0.0 if previous is None else min((timestamp - previous) / speed, REPLAY_MAX_WAIT)
+        previous = timestamp
+        yield wait, codec_name, data
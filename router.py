@@ -0,0 +1,348 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import re
+import secrets
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web, WSMsgType
+
+# Runs WORKERS copies of browser.py, each on its own port and display, and
+# serves them all from PORT. Every session is pinned to one worker by
+# consistent hashing, so a renderer crash only takes that worker's sessions
+# down, and a restart moves nothing but them.
+#
+#   WORKERS=4 python router.py
+
+WORKERS = int(os.environ.get("WORKERS", str(os.cpu_count() or 1)))
+ROUTER_PORT = int(os.environ.get("PORT", "5000"))
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "5100"))
+DEVTOOLS_BASE_PORT = int(os.environ.get("DEVTOOLS_BASE_PORT", "9300"))
+# "xvfb" starts an Xvfb server per worker; "offscreen" uses Qt's offscreen platform
+WORKER_DISPLAY = os.environ.get("WORKER_DISPLAY", "xvfb")
+XVFB_BASE_DISPLAY = 90
+XVFB_SCREEN = "1280x720x24"
+# browser.py's RECORD_DIR and PROFILE_DIR; each worker gets a subdirectory of
+# them (Chromium can't share one on-disk profile between processes)
+RECORD_DIR = os.environ.get("RECORD_DIR")
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+HEALTH_INTERVAL = 2.0
+HEALTH_TIMEOUT = 2.0
+# Failed checks in a row before a worker is killed and restarted
+HEALTH_FAILURES = 3
+# A fresh worker gets this long to answer its first health check
+STARTUP_GRACE = 30.0
+# Points per worker on the hash ring; more spreads sessions more evenly
+RING_REPLICAS = 64
+
+DEFAULT_SESSION = "default"
+# /s/<sid>/... is the session's browser; /recordings/<sid>... is read from the
+# worker that recorded it
+SESSION_PATH = re.compile(r'^/(?:s/([^/]+)/|recordings/([^/]+))')
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BROWSER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'browser.py')
+
+# Per-connection headers that must not be forwarded by a proxy
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+              'te', 'trailers', 'transfer-encoding', 'upgrade', 'host'}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def session_id(path):
+    match = SESSION_PATH.match(path)
+    return (match.group(1) or match.group(2)) if match else DEFAULT_SESSION
+
+
+def forwarded(headers):
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+
+
+def merge_metrics(scrapes):
+    """Joins workers' /metrics pages into one, each sample labelled with its worker.
+
+    scrapes is [(worker index, text)]. The exposition format wants each
+    metric's samples together under one HELP/TYPE, so they are regrouped
+    rather than concatenated.
+    """
+    families = {}
+    for index, text in scrapes:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                _, kind, name, *_ = line.split(' ', 3) + ['']
+                family = families.setdefault(name, ([], []))
+                if kind in ('HELP', 'TYPE') and len(family[0]) < 2:
+                    family[0].append(line)
+            elif line and family is not None:
+                name, _, rest = line.partition(' ')
+                label = f'worker="{index}"'
+                if name.endswith('}'):
+                    name = name[:name.index('{') + 1] + label + ',' + name[name.index('{') + 1:]
+                else:
+                    name = name + '{' + label + '}'
+                family[1].append(f"{name} {rest}")
+    lines = [line for headers, samples in families.values() for line in headers + samples]
+    return "\n".join(lines) + "\n"
+
+
+class HashRing:
+    """Consistent hashing of session ids onto workers.
+
+    Taking a worker out only remaps the sessions that hashed to it; every
+    other session stays where its browser state is.
+    """
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        points = sorted(((_hash(f"worker-{w.index}-{i}"), w.index) for w in workers for i in range(replicas)))
+        self._keys = [key for key, _ in points]
+        self._workers = {w.index: w for w in workers}
+        self._owners = [index for _, index in points]
+
+    def lookup(self, key):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._workers[self._owners[i]]
+
+
+class Worker:
+    """One browser.py process and, in xvfb mode, the X server it renders on."""
+
+    def __init__(self, index):
+        self.index = index
+        self.port = WORKER_BASE_PORT + index
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = None
+        self.xvfb = None
+        self.healthy = False
+        self.failures = 0
+        self.restarts = 0
+        self.started = 0.0
+
+    def start(self):
+        # The default session opens on whichever worker it hashes to when first
+        # requested, rather than on every worker at start-up
+        env = dict(os.environ, PORT=str(self.port), DEVTOOLS_PORT=str(DEVTOOLS_BASE_PORT + self.index),
+                   OPEN_DEFAULT_SESSION="0")
+        # Any worker may end up with the default session (the ring moves it when
+        # a worker goes down); each records and keeps its profile in its own tree
+        if RECORD_DIR:
+            env['RECORD_DIR'] = os.path.join(RECORD_DIR, f"worker-{self.index}")
+        if PROFILE_DIR:
+            env['PROFILE_DIR'] = os.path.join(PROFILE_DIR, f"worker-{self.index}")
+        if WORKER_DISPLAY == "xvfb":
+            display = f":{XVFB_BASE_DISPLAY + self.index}"
+            self.xvfb = subprocess.Popen(['Xvfb', display, '-screen', '0', XVFB_SCREEN, '-nolisten', 'tcp'],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            env['DISPLAY'] = display
+        else:
+            env['QT_QPA_PLATFORM'] = 'offscreen'
+        self.process = subprocess.Popen([sys.executable, BROWSER_SCRIPT], env=env)
+        self.started = time.monotonic()
+        self.healthy = False
+        self.failures = 0
+        print(f"[router] worker {self.index}: pid {self.process.pid} on port {self.port}")
+
+    def stop(self):
+        for proc in (self.process, self.xvfb):
+            if proc is None or proc.poll() is not None:
+                continue
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        self.healthy = False
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def describe(self):
+        return {'index': self.index, 'port': self.port, 'healthy': self.healthy,
+                'pid': self.process.pid if self.process else None, 'restarts': self.restarts}
+
+
+class Router:
+    """Front end that proxies each session's pages, streams and input to its worker."""
+
+    def __init__(self, count=WORKERS):
+        self.workers = [Worker(i) for i in range(count)]
+        self.ring = HashRing([])
+        self.client = None
+        self._supervisor = None
+
+    def routes(self):
+        return [
+            web.get('/new', self.new_session),
+            web.get('/sessions', self.list_sessions),
+            web.get('/healthz', self.healthz),
+            web.get('/metrics', self.metrics),
+            web.route('*', '/{tail:.*}', self.proxy),
+        ]
+
+    async def on_startup(self, app):
+        # No total timeout: streams stay open for as long as the viewer does
+        self.client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=5),
+                                            auto_decompress=False)
+        for worker in self.workers:
+            worker.start()
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def on_cleanup(self, app):
+        self._supervisor.cancel()
+        await self.client.close()
+        await asyncio.gather(*(asyncio.to_thread(w.stop) for w in self.workers))
+
+    def worker_for(self, sid):
+        return self.ring.lookup(sid)
+
+    # --- Health ---
+
+    async def _supervise(self):
+        while True:
+            await asyncio.gather(*(self._check(w) for w in self.workers))
+            self.ring = HashRing([w for w in self.workers if w.healthy])
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _check(self, worker):
+        code = worker.process.poll()
+        if code is not None:
+            print(f"[router] worker {worker.index} exited with {code}; restarting")
+            await asyncio.to_thread(worker.restart)
+            return
+
+        try:
+            async with self.client.get(worker.url + '/healthz',
+                                       timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as resp:
+                ok = resp.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+
+        if ok:
+            if not worker.healthy:
+                print(f"[router] worker {worker.index} is up")
+            worker.healthy = True
+            worker.failures = 0
+        elif worker.healthy or time.monotonic() - worker.started > STARTUP_GRACE:
+            worker.failures += 1
+            if worker.failures >= HEALTH_FAILURES:
+                print(f"[router] worker {worker.index} failed {worker.failures} health checks; restarting")
+                await asyncio.to_thread(worker.restart)
+
+    async def healthz(self, request):
+        workers = [w.describe() for w in self.workers]
+        ok = any(w['healthy'] for w in workers)
+        return web.json_response({'ok': ok, 'workers': workers}, status=200 if ok else 503)
+
+    async def metrics(self, request):
+        """Every healthy worker's /metrics, labelled by worker, so one scrape covers them all."""
+        async def fetch(worker):
+            try:
+                async with self.client.get(worker.url + '/metrics',
+                                           timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as resp:
+                    return worker.index, await resp.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return worker.index, ''
+
+        scrapes = await asyncio.gather(*(fetch(w) for w in self.workers if w.healthy))
+        return web.Response(text=merge_metrics(scrapes), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+    # --- Sessions ---
+
+    async def new_session(self, request):
+        raise web.HTTPFound(f'/s/{secrets.token_urlsafe(8)}/')
+
+    async def list_sessions(self, request):
+        async def fetch(worker):
+            try:
+                async with self.client.get(worker.url + '/sessions',
+                                           timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as resp:
+                    sessions = (await resp.json())['sessions']
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+                return []
+            return [dict(s, worker=worker.index) for s in sessions]
+
+        results = await asyncio.gather(*(fetch(w) for w in self.workers if w.healthy))
+        return web.json_response({'sessions': [s for found in results for s in found]})
+
+    # --- Proxying ---
+
+    async def proxy(self, request):
+        worker = self.worker_for(session_id(request.path))
+        if worker is None:
+            return web.Response(text="No healthy browser workers", status=503)
+        url = worker.url + request.rel_url.path_qs
+        if request.headers.get('Upgrade', '').lower() == 'websocket':
+            return await self._proxy_ws(request, url)
+
+        body = await request.read() if request.can_read_body else None
+        try:
+            upstream = await self.client.request(request.method, url, headers=forwarded(request.headers),
+                                                 data=body, allow_redirects=False)
+        except aiohttp.ClientError as e:
+            return web.Response(text=f"Worker {worker.index} unavailable: {e}", status=502)
+
+        resp = web.StreamResponse(status=upstream.status, headers=forwarded(upstream.headers))
+        try:
+            await resp.prepare(request)
+            # Chunks go out as they arrive, so MJPEG and tile streams aren't buffered
+            async for chunk in upstream.content.iter_any():
+                await resp.write(chunk)
+        except (ConnectionResetError, aiohttp.ClientError):
+            pass
+        finally:
+            upstream.release()
+        return resp
+
+    async def _proxy_ws(self, request, url):
+        try:
+            upstream = await self.client.ws_connect(url, max_msg_size=0)
+        except aiohttp.ClientError as e:
+            return web.Response(text=f"Worker unavailable: {e}", status=502)
+
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+
+        async def pipe(src, dst):
+            async for msg in src:
+                if msg.type == WSMsgType.BINARY:
+                    await dst.send_bytes(msg.data)
+                elif msg.type == WSMsgType.TEXT:
+                    await dst.send_str(msg.data)
+                else:
+                    break
+
+        tasks = [asyncio.create_task(pipe(ws, upstream)), asyncio.create_task(pipe(upstream, ws))]
+        try:
+            # Either side closing (or the worker dying) ends both directions
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await upstream.close()
+            await ws.close()
+        return ws
+
+
+def run_router(router, host='0.0.0.0', port=ROUTER_PORT):
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.add_routes(router.routes())
+    app.on_startup.append(router.on_startup)
+    app.on_cleanup.append(router.on_cleanup)
+    web.run_app(app, host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    print(f"Starting router on port {ROUTER_PORT} with {WORKERS} workers...")
+    run_router(Router())
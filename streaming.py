@@ -0,0 +1,430 @@
+# Frames, their encoding, stream sizing and the input wire formats shared by every server front end.
+import itertools
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PyQt6.QtCore import QBuffer, QIODevice, Qt
+from PyQt6.QtGui import QImage, QImageReader
+
+import metrics
+from frame_codecs import DEFAULT_CODEC, JPEG, negotiate
+
+# --- Frame Broadcasting ---
+JPEG_QUALITY = 30
+
+# Multipart header for one stream part; built once per frame variant. The
+# stream keeps its MJPEG name, but parts carry whatever codec the client chose.
+MJPEG_PART_HEADER = (b'--frame\r\n'
+                     b'Content-Type: %s\r\n'
+                     b'Content-Length: %d\r\n\r\n')
+
+
+def mjpeg_part(mime, data):
+    """One multipart/x-mixed-replace part holding an encoded image."""
+    return b''.join((MJPEG_PART_HEADER % (mime.encode(), len(data)), data, b'\r\n'))
+
+
+class Frame:
+    """A captured frame and every encoding of it that clients have asked for.
+
+    data is the default encoding (codec at JPEG_QUALITY, full size). Other
+    (codec, quality, width) variants are encoded on first request, and each
+    variant's MJPEG part and WebSocket message are framed once. Every
+    client gets the same bytes objects, so nothing is copied per client.
+    """
+
+    def __init__(self, data, image=None, captured=None, codec=JPEG):
+        self.data = data
+        self.codec = codec
+        # monotonic time the view was captured at
+        self.captured = captured if captured is not None else time.monotonic()
+        self._image = image
+        self._size = image.size() if image is not None else None
+        self._lock = threading.Lock()
+        self._cache = {self._key('image', codec, JPEG_QUALITY, None): data}
+        self._building = {}
+
+    @staticmethod
+    def _key(kind, codec, quality, width):
+        # Lossless encodings are the same at every quality, so they share one entry
+        return (kind, codec.name, None if codec.lossless else quality, width)
+
+    @property
+    def image(self):
+        # Screencast frames arrive encoded only; decode when a variant needs pixels
+        if self._image is None:
+            self._image = QImage.fromData(self.data)
+        return self._image
+
+    @property
+    def size(self):
+        """(width, height) of the view the frame was captured from."""
+        if self._size is None:
+            buffer = QBuffer()
+            buffer.setData(self.data)
+            buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+            self._size = QImageReader(buffer).size()
+        return self._size.width(), self._size.height()
+
+    def _cached(self, key, build, encode=True):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None or not encode:
+                return value
+            key_lock = self._building.setdefault(key, threading.Lock())
+
+        # Clients asking for the same thing wait for one build instead of repeating it
+        with key_lock:
+            with self._lock:
+                value = self._cache.get(key)
+            if value is None:
+                value = build()
+                with self._lock:
+                    self._cache[key] = value
+        return value
+
+    def _full_size(self, width):
+        return width is None or width >= self.size[0]
+
+    # With encode=False these return None instead of building something that
+    # isn't cached yet, so async callers can push the work to a thread
+
+    def encoded(self, quality=JPEG_QUALITY, width=None, encode=True, codec=JPEG):
+        """This frame in codec at quality, downscaled to width (None = full size)."""
+        if self._full_size(width):
+            width = None
+        return self._cached(self._key('image', codec, quality, width),
+                            lambda: self._encode(codec, quality, width), encode)
+
+    def mjpeg_part(self, quality=JPEG_QUALITY, width=None, encode=True, codec=JPEG):
+        """The complete multipart part (header, image, trailer) for a variant."""
+        if self._full_size(width):
+            width = None
+
+        def build():
+            return mjpeg_part(codec.mime, self.encoded(quality, width, codec=codec))
+        return self._cached(self._key('mjpeg', codec, quality, width), build, encode)
+
+    def ws_message(self, quality=JPEG_QUALITY, width=None, encode=True, codec=JPEG):
+        """The WS_FRAME socket message for a variant."""
+        if self._full_size(width):
+            width = None
+
+        def build():
+            return WS_FRAME_HEADER.pack(WS_FRAME, *self.size) + self.encoded(quality, width, codec=codec)
+        return self._cached(self._key('ws', codec, quality, width), build, encode)
+
+    def _encode(self, codec, quality, width):
+        image = self.image
+        if width is not None:
+            height = max(1, round(image.height() * width / image.width()))
+            image = image.scaled(width, height,
+                                 Qt.AspectRatioMode.IgnoreAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        with metrics.VARIANT_ENCODE_SECONDS.time():
+            return codec.encode(image, quality)
+
+class FrameBroadcaster:
+    """Holds the newest Frame and wakes stream clients when it changes."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._frame = None
+        self._listeners = []
+        self._input = None
+        # View size from the latest capture that wasn't published (see captured())
+        self._size = None
+        self.viewers = 0
+
+    def add_listener(self, callback):
+        """Calls callback() on the publishing thread after every new frame."""
+        self._listeners.append(callback)
+
+    @contextmanager
+    def viewer(self):
+        """Counts a connected stream client for as long as the block runs."""
+        with self._cond:
+            self.viewers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    def mark_input(self, arrived, applied):
+        """Input that arrived at `arrived` was applied to the view at `applied`.
+
+        The first frame captured after that is timed as the input's
+        input-to-frame latency. Marks made while one is pending are ignored.
+        """
+        with self._cond:
+            if self._input is None:
+                self._input = (arrived, applied)
+
+    def _shown(self, captured):
+        """The pending input mark if a capture taken at captured shows it (call under _cond)."""
+        pending, self._input = self._input, None
+        if pending is not None and captured < pending[1]:
+            # Captured before the input took effect; wait for the next frame
+            self._input, pending = pending, None
+        return pending
+
+    def publish(self, frame):
+        with self._cond:
+            # Identical frame (idle page): don't wake anyone
+            if self._frame is not None and frame.data == self._frame.data:
+                metrics.FRAMES_DUPLICATE.inc()
+                return
+            self._seq += 1
+            self._frame = frame
+            self._size = None
+            self._cond.notify_all()
+            pending = self._shown(frame.captured)
+        metrics.FRAMES_PUBLISHED.inc()
+        metrics.FRAME_BYTES.observe(len(frame.data))
+        if pending is not None:
+            metrics.INPUT_TO_FRAME.observe(time.monotonic() - pending[0])
+        for callback in self._listeners:
+            callback()
+
+    def captured(self, size, captured):
+        """A changed picture went out some other way (tiles) without a full frame.
+
+        Keeps view_size() and the input-to-frame timing current for clients
+        that never see a published frame.
+        """
+        with self._cond:
+            self._size = size
+            pending = self._shown(captured)
+        if pending is not None:
+            metrics.INPUT_TO_FRAME.observe(time.monotonic() - pending[0])
+
+    def wait_for_frame(self, last_seq, timeout=None):
+        """Block until a frame newer than last_seq exists.
+
+        Returns (seq, frame) for the newest Frame. Frames published while the
+        caller was busy are skipped, so slow clients never fall behind.
+        On timeout the current frame is returned unchanged.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > last_seq, timeout)
+            return self._seq, self._frame
+
+    def view_size(self):
+        """(width, height) of the most recent frame's view, or (0, 0) before the first one."""
+        with self._cond:
+            frame, size = self._frame, self._size
+        if size is not None:
+            return size
+        return frame.size if frame is not None else (0, 0)
+
+# --- Frame Encoding ---
+# Frame encoding runs off the GUI thread so input handling isn't stuck behind it
+ENCODER_WORKERS = 2
+
+class FrameEncoder:
+    """Encodes grabbed QImages on a bounded worker pool and publishes them in capture order.
+
+    sequence numbers the captures; pass the session's so they keep
+    increasing when the view (and its encoder) is replaced. With tiles,
+    full frames are only encoded while a /stream.mjpeg client watches or
+    recording is set (the recorder stores full frames).
+    """
+
+    def __init__(self, broadcaster, tiles=None, workers=ENCODER_WORKERS, pool=None, sequence=None,
+                 recording=False):
+        self._broadcaster = broadcaster
+        self._tiles = tiles
+        self._recording = recording
+        self._workers = workers
+        # Sessions share one pool; workers only caps how many of ours are in flight
+        self._pool = pool or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encoder")
+        self._lock = threading.Lock()
+        # Orders publishes between encoder threads. Listeners (the recorder)
+        # run under it, so it must never be taken on the GUI thread
+        self._publish_lock = threading.Lock()
+        self._in_flight = 0
+        self._sequence = sequence or itertools.count(1)
+        self._published_seq = 0
+        self.dropped = 0
+
+    def submit(self, grab):
+        """Reserve a worker, call grab() for a QImage and queue it for encoding.
+
+        If every worker is busy the frame is dropped without calling grab().
+        """
+        with self._lock:
+            if self._in_flight >= self._workers:
+                self.dropped += 1
+                metrics.FRAMES_DROPPED.inc()
+                return False
+            self._in_flight += 1
+            seq = next(self._sequence)
+        try:
+            captured = time.monotonic()
+            with metrics.GRAB_SECONDS.time():
+                image = grab()
+        except Exception:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        self._pool.submit(self._encode, seq, image, captured)
+        return True
+
+    def _encode(self, seq, image, captured):
+        try:
+            if self._tiles is not None:
+                with metrics.TILES_SECONDS.time():
+                    changed = self._tiles.update(seq, image)
+                # Only pay for full frames while someone watches /stream.mjpeg or it is recorded
+                if not self._broadcaster.viewers and not self._recording:
+                    if changed:
+                        self._broadcaster.captured((image.width(), image.height()), captured)
+                    return
+
+            with metrics.ENCODE_SECONDS.time():
+                frame = Frame(DEFAULT_CODEC.encode(image, JPEG_QUALITY), image, captured, DEFAULT_CODEC)
+
+            with self._publish_lock:
+                with self._lock:
+                    # A later capture finished first; never publish frames backwards
+                    if seq < self._published_seq:
+                        self.dropped += 1
+                        metrics.FRAMES_DROPPED.inc()
+                        return
+                    self._published_seq = seq
+                # submit() only needs _lock, so capture isn't held up by the listeners
+                self._broadcaster.publish(frame)
+        except Exception as e:
+            print(f"Encoder error: {e}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+# Resend the current frame this often on idle pages so dead clients are noticed
+STREAM_KEEPALIVE_SECONDS = 2.0
+
+# Frame widths clients can be sent. Requested sizes snap up to the next one,
+# so clients with similar screens share a single encode per frame.
+STREAM_WIDTHS = (320, 480, 640, 800, 1024, 1280, 1600, 1920, 2560)
+
+def stream_width(requested, view_size, scale=1.0):
+    """Width to encode for a client that asked for a (width, height) box.
+
+    0 in the box means "no limit". Returns None for full size.
+    """
+    view_width, view_height = view_size
+    if not view_width or not view_height:
+        return None
+    req_width, req_height = requested
+    target = view_width
+    if req_width:
+        target = min(target, req_width)
+    if req_height:
+        target = min(target, req_height * view_width / view_height)
+    target *= scale
+    for width in STREAM_WIDTHS:
+        if width >= target:
+            return width if width < view_width else None
+    return None
+
+def client_variant(frame, abr, requested):
+    """(quality, width) of frame one client should get, given its adaptive level and requested size."""
+    quality, scale = (abr.quality, abr.scale) if abr else (JPEG_QUALITY, 1.0)
+    return quality, stream_width(requested, frame.size, scale)
+
+def requested_size(args):
+    """(w, h) a client asked for in its query string; 0 where unset."""
+    return (int(args.get('w', 0) or 0), int(args.get('h', 0) or 0))
+
+def requested_codec(args):
+    """The frame codec a client negotiated with ?codec=a,b (see frame_codecs.py)."""
+    return negotiate(args.get('codec'))
+
+# Per-client JPEG quality / scale / frame rate driven by backpressure (see abr.py)
+ADAPTIVE_BITRATE = os.environ.get("ADAPTIVE_BITRATE", "1") == "1"
+
+# --- Input Events ---
+def to_view(view_size, x, y, frame_width=None, frame_height=None):
+    """Maps a point on a (possibly downscaled) frame of the given size to view coordinates.
+
+    Clients that don't send the frame size are assumed to use view coordinates.
+    """
+    view_width, view_height = view_size
+    if not frame_width or not frame_height or not view_width:
+        return int(x), int(y)
+    return round(int(x) * view_width / int(frame_width)), round(int(y) * view_height / int(frame_height))
+
+def parse_input_event(event, view_size):
+    """Turns one JSON input event from /input into a command tuple.
+
+    Pointer events may carry fw/fh, the size of the frame x/y refer to.
+    """
+    kind = event['type']
+    if 'x' in event:
+        x, y = to_view(view_size, event['x'], event['y'], event.get('fw'), event.get('fh'))
+    if kind == 'click':
+        return ('click', x, y)
+    if kind == 'key':
+        return ('type', str(event['key']))
+    if kind == 'navigate':
+        return ('navigate', str(event['url']))
+    if kind in ('down', 'up'):
+        return (kind, x, y, int(event.get('button', 0)))
+    if kind == 'move':
+        return ('move', x, y, int(event.get('buttons', 0)))
+    if kind == 'wheel':
+        return ('wheel', x, y, int(event.get('dx', 0)), int(event.get('dy', 0)))
+    raise ValueError(f"Unknown input type {kind!r}")
+
+# --- WebSocket Protocol ---
+# One socket carries frames down and input up, in order, with no per-event HTTP.
+# Server -> client: 1 byte type, then an image (WS_FRAME, prefixed with the u16 width
+# and height of the view, since the image may be downscaled), a tile message (WS_TILES)
+# or the utf-8 name of the frame codec, sent before the first frame (WS_CODEC).
+# Client -> server: 1 byte type, u32 input seq, then the event fields.
+WS_FRAME = 1
+WS_TILES = 2
+WS_CODEC = 3
+
+INPUT_CLICK = 1     # u16 x, u16 y
+INPUT_KEY = 2       # utf-8 key name
+INPUT_NAVIGATE = 3  # utf-8 url
+INPUT_DOWN = 4      # u16 x, u16 y, u8 button
+INPUT_UP = 5        # u16 x, u16 y, u8 button
+INPUT_MOVE = 6      # u16 x, u16 y, u8 buttons
+INPUT_WHEEL = 7     # u16 x, u16 y, i16 dx, i16 dy
+INPUT_VIEWPORT = 8  # u16 w, u16 h: frame size this client wants (not an input event)
+
+WS_FRAME_HEADER = struct.Struct('<BHH')
+INPUT_HEADER = struct.Struct('<BI')
+INPUT_POINT = struct.Struct('<HH')
+INPUT_BUTTON = struct.Struct('<HHB')
+INPUT_SCROLL = struct.Struct('<HHhh')
+
+def decode_input(msg):
+    """Turns a binary input message into (seq, command tuple for command_queue)."""
+    kind, seq = INPUT_HEADER.unpack_from(msg)
+    body = msg[INPUT_HEADER.size:]
+    if kind == INPUT_CLICK:
+        x, y = INPUT_POINT.unpack(body)
+        return seq, ('click', x, y)
+    if kind == INPUT_KEY:
+        return seq, ('type', body.decode('utf-8'))
+    if kind == INPUT_NAVIGATE:
+        return seq, ('navigate', body.decode('utf-8'))
+    if kind in (INPUT_DOWN, INPUT_UP):
+        x, y, button = INPUT_BUTTON.unpack(body)
+        return seq, ('down' if kind == INPUT_DOWN else 'up', x, y, button)
+    if kind == INPUT_MOVE:
+        return seq, ('move', *INPUT_BUTTON.unpack(body))
+    if kind == INPUT_WHEEL:
+        return seq, ('wheel', *INPUT_SCROLL.unpack(body))
+    if kind == INPUT_VIEWPORT:
+        return seq, ('viewport', *INPUT_POINT.unpack(body))
+    raise ValueError(f"Unknown input type {kind}")
@@ -0,0 +1,58 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtGui import QColor, QImage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recorder import RecordingReader, SessionRecorder  # noqa: E402
+from streaming import FrameBroadcaster, FrameEncoder  # noqa: E402
+from tiles import TileEncoder  # noqa: E402
+
+
+def image(color):
+    picture = QImage(320, 240, QImage.Format.Format_RGB32)
+    picture.fill(QColor(color))
+    return picture
+
+
+def capture(encoder, pool, colors):
+    """Submits one capture per color, waiting for each so none is dropped as busy."""
+    for color in colors:
+        assert encoder.submit(lambda: image(color))
+        pool.submit(lambda: None).result()
+
+
+def test_tiles_mode_records_frames(tmp_path):
+    frames = FrameBroadcaster()
+    recorder = SessionRecorder(str(tmp_path))
+
+    def record_frame():
+        # As Session does: every published frame is recorded
+        seq, frame = frames.wait_for_frame(0, timeout=0)
+        recorder.record_frame(seq, frame, frame.codec.name)
+
+    frames.add_listener(record_frame)
+    pool = ThreadPoolExecutor(max_workers=1)
+    encoder = FrameEncoder(frames, tiles=TileEncoder(), workers=1, pool=pool, recording=True)
+
+    capture(encoder, pool, ['red', 'green', 'blue'])
+    recorder.close()
+
+    with RecordingReader(str(tmp_path)) as reader:
+        assert reader.summary()['frames'] == 3
+
+
+def test_tiles_mode_without_viewers_tracks_view_size(tmp_path):
+    frames = FrameBroadcaster()
+    pool = ThreadPoolExecutor(max_workers=1)
+    tiles = TileEncoder()
+    encoder = FrameEncoder(frames, tiles=tiles, workers=1, pool=pool)
+
+    capture(encoder, pool, ['red'])
+
+    # No /stream.mjpeg viewer: tiles only, but clicks still need the view size
+    assert frames.wait_for_frame(0, timeout=0) == (0, None)
+    assert tiles.seq == 1
+    assert frames.view_size() == (320, 240)
@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'legacy_proxy'))
+
+from response_cache import ResponseCache, CachedResponse  # noqa: E402
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Greets the visitor named by their sid cookie, with the Cache-Control/Vary/ETag from the query."""
+
+    def do_GET(self):
+        query = dict(part.split('=', 1) for part in self.path.partition('?')[2].split('&') if part)
+        body = f"hello {self.headers.get('Cookie', 'anonymous')}".encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', query.get('cc', 'max-age=60').replace('+', ' '))
+        if 'vary' in query:
+            self.send_header('Vary', query['vary'])
+        if 'etag' in query:
+            self.send_header('ETag', '"%s"' % query['etag'])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def origin():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def visitor(sid=None):
+    session = requests.Session()
+    if sid:
+        session.cookies.set('sid', sid, domain='127.0.0.1')
+    return session
+
+
+def fetch(cache, session, url):
+    resp = cache.get(session, url)
+    if isinstance(resp, CachedResponse):
+        return resp
+    body = resp.content
+    cache.store(resp, body)
+    return resp
+
+
+@pytest.mark.parametrize('query', ['vary=Cookie', 'vary=Accept-Encoding,+Cookie', 'vary=Authorization',
+                                   'cc=max-age=60'])
+def test_visitor_pages_are_not_shared(origin, tmp_path, query):
+    cache = ResponseCache(directory=str(tmp_path))
+    url = f'{origin}/page?{query}'
+    assert fetch(cache, visitor('alice'), url).content == b'hello sid=alice'
+    bob = fetch(cache, visitor('bob'), url)
+    assert not isinstance(bob, CachedResponse)
+    assert bob.content == b'hello sid=bob'
+
+
+@pytest.mark.parametrize('cc', ['public,+max-age=60', 's-maxage=60'])
+def test_shared_responses_to_visitors_with_cookies_are_cached(origin, tmp_path, cc):
+    cache = ResponseCache(directory=str(tmp_path))
+    url = f'{origin}/page?cc={cc}'
+    fetch(cache, visitor('alice'), url)
+    assert isinstance(fetch(cache, visitor('bob'), url), CachedResponse)
+
+
+def test_anonymous_responses_are_cached(origin, tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    url = f'{origin}/page'
+    fetch(cache, visitor(), url)
+    cached = fetch(cache, visitor(), url)
+    assert isinstance(cached, CachedResponse)
+    assert cached.content == b'hello anonymous'
+
+
+@pytest.mark.parametrize('query, entries', [('cc=no-cache', 0), ('cc=max-age=0', 0),
+                                            ('cc=no-cache&etag=v1', 1)])
+def test_stale_responses_are_stored_only_with_a_validator(origin, tmp_path, query, entries):
+    cache = ResponseCache(directory=str(tmp_path))
+    fetch(cache, visitor(), f'{origin}/page?{query}')
+    assert cache.stats()['entries'] == entries
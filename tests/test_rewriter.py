@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'legacy_proxy'))
+
+from rewriter import rewrite_html  # noqa: E402
+
+BASE = 'https://example.com/a/'
+Q_PNG = b'/proxy?url=https%3A%2F%2Fexample.com%2Fa%2Fq.png'
+
+
+@pytest.mark.parametrize('page, expected', [
+    (b'<div style="background:url(&quot;q.png&quot;)">',
+     b'<div style="background:url(&quot;' + Q_PNG + b'&quot;)">'),
+    (b'<div style="background:url(&#39;q.png&#39;)">',
+     b'<div style="background:url(&#39;' + Q_PNG + b'&#39;)">'),
+    (b'<div style=\'background:url("q.png")\'>',
+     b'<div style=\'background:url("' + Q_PNG + b'")\'>'),
+    (b'<img srcset="q.png?w=1&amp;h=2 1x">',
+     b'<img srcset="/proxy?url=https%3A%2F%2Fexample.com%2Fa%2Fq.png%3Fw%3D1%26h%3D2 1x">'),
+])
+def test_style_and_srcset_entities_are_decoded(page, expected):
+    assert rewrite_html(page, BASE) == expected
+
+
+def test_css_urls_are_not_entity_decoded():
+    page = b'<style>a{background:url(q.png?a=1&copy=2)}</style>'
+    assert rewrite_html(page, BASE) == (b'<style>a{background:url(/proxy?url=https%3A%2F%2Fexample.com'
+                                        b'%2Fa%2Fq.png%3Fa%3D1%26copy%3D2)}</style>')
+
+
+def test_untouched_attributes_keep_their_bytes():
+    page = b'<div style="color:red;content:&quot;x&quot;">'
+    assert rewrite_html(page, BASE) == page
@@ -0,0 +1,136 @@
+import struct
+import threading
+
+import numpy as np
+from PyQt6.QtCore import QBuffer, QIODevice, QRect
+from PyQt6.QtGui import QImage
+
+# Tile edge in pixels (a multiple of the 8x8 JPEG block size)
+TILE_SIZE = 64
+
+# Message: length (bytes after this field), seq, frame width, frame height, tile count
+MESSAGE_HEADER = struct.Struct('<IIHHH')
+# Per tile: x, y, width, height, image length, then the image bytes
+TILE_HEADER = struct.Struct('<HHHHI')
+
+
+def padded_pixels(image, tile_size):
+    """Copy a QImage into a (rows, cols) uint32 array padded to whole tiles."""
+    image = image.convertToFormat(QImage.Format.Format_RGB32)
+    width, height = image.width(), image.height()
+    ptr = image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    src = np.frombuffer(ptr, dtype=np.uint32).reshape(height, image.bytesPerLine() // 4)
+
+    rows = -(-height // tile_size) * tile_size
+    cols = -(-width // tile_size) * tile_size
+    pixels = np.zeros((rows, cols), dtype=np.uint32)
+    pixels[:height, :width] = src[:, :width]
+    return pixels
+
+
+def encode_jpeg(image, quality):
+    buffer = QBuffer()
+    buffer.open(QIODevice.OpenModeFlag.ReadWrite)
+    image.save(buffer, "JPG", quality=quality)
+    return buffer.data().data()
+
+
+class TileEncoder:
+    """Diffs captured frames tile by tile and keeps the latest JPEG of every tile.
+
+    Each tile remembers the seq it last changed at. A client sends back the
+    seq it has seen and gets only the tiles that changed after it, so clients
+    that skipped frames (or just connected with seq 0) still end up with a
+    complete picture.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE, quality=30, codec=None):
+        self.tile_size = tile_size
+        self.quality = quality
+        # A frame_codecs.Codec for the tiles; JPEG by default
+        self._encode_tile = codec.encode if codec is not None else encode_jpeg
+        self.seq = 0
+
+        # Serialises update() so frames are diffed in capture order
+        self._update_lock = threading.Lock()
+        self._frame_seq = 0
+        self._pixels = None
+
+        # Guards the state read by stream clients
+        self._cond = threading.Condition()
+        self._size = (0, 0)
+        self._versions = None
+        self._tiles = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Calls callback() on the encoding thread after every update with changes."""
+        self._listeners.append(callback)
+
+    def update(self, frame_seq, image):
+        """Diff a captured QImage against the previous frame and encode changed tiles.
+
+        Frames older than the last one processed are ignored. Returns True if
+        any tile changed.
+        """
+        t = self.tile_size
+        pixels = padded_pixels(image, t)
+        size = (image.width(), image.height())
+
+        with self._update_lock:
+            if frame_seq <= self._frame_seq:
+                return False
+            self._frame_seq = frame_seq
+
+            grid = (pixels.shape[0] // t, pixels.shape[1] // t)
+            resized = self._pixels is None or size != self._size
+            if resized:
+                changed = np.ones(grid, dtype=bool)
+            else:
+                # One vectorised compare over the whole frame, reduced per tile
+                changed = (pixels != self._pixels).reshape(grid[0], t, grid[1], t).any(axis=(1, 3))
+            self._pixels = pixels
+
+            if not changed.any():
+                return False
+
+            width, height = size
+            encoded = {}
+            for row, col in zip(*(idx.tolist() for idx in np.nonzero(changed))):
+                x, y = col * t, row * t
+                w, h = min(t, width - x), min(t, height - y)
+                data = self._encode_tile(image.copy(QRect(x, y, w, h)), self.quality)
+                encoded[(row, col)] = TILE_HEADER.pack(x, y, w, h, len(data)) + data
+
+            with self._cond:
+                self.seq += 1
+                if resized:
+                    self._size = size
+                    self._versions = np.zeros(grid, dtype=np.int64)
+                    self._tiles = {}
+                self._versions[changed] = self.seq
+                self._tiles.update(encoded)
+                self._cond.notify_all()
+            for callback in self._listeners:
+                callback()
+            return True
+
+    def wait_for_delta(self, last_seq, timeout=None):
+        """Block until tiles newer than last_seq exist and return (seq, message).
+
+        On timeout the message carries no tiles (a cheap keep-alive). message
+        is None until the first frame has been processed.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > last_seq, timeout)
+            if self._versions is None:
+                return last_seq, None
+            rows, cols = np.nonzero(self._versions > last_seq)
+            parts = [self._tiles[key] for key in zip(rows.tolist(), cols.tolist())]
+            seq = self.seq
+            width, height = self._size
+
+        body = b''.join(parts)
+        header = MESSAGE_HEADER.pack(MESSAGE_HEADER.size - 4 + len(body), seq, width, height, len(parts))
+        return seq, header + body